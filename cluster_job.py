@@ -6,12 +6,23 @@ __version__ = "0.5"
 from string import *
 import sys
 import traceback
+import tempfile
+import shutil
+import time
+import threading
+import Queue
+import heapq
+import zlib
+import subprocess
+import multiprocessing
+from hashlib import md5
+from itertools import islice, chain
 from commands import *
 from MMlib import *
 #### default options:
 def_opt= {'i':0,  'o':0, 'n':None, 'c':None, 'H':0, 'qsub':0, 'p':1, 'm':12, 'N':0, 't':6, 'v':0, 'n_lines':0, 'n_jobs':0, 'F':0, 'r':None,
 'q':'queue1,queue2', 'bin':'~/bin', 'email':'youremail@domain.com', 'E':'a', 'e':0, 'f':0, 'x':0, 'joe':0, 'sl':0, 'so':'', 'srun':0,
-'pe':'smp', 'sys':'sge', 'q_syn':'S=queue1,queue2;L=queue3,queue2', 'peq':'queue_arg1=pe_type1;queue_arg2=pe_type2' }
+'pe':'smp', 'sys':'sge', 'ix':0, 'sm':'each', 'sp':4, 'rate':0, 'retry':3, 'resume':0, 'wt':1, 'cost':None, 'ch':0, 'xp':0, 'inc':0, 'rf':0, 'st':0, 'max':0, 'chain':0, 'tc':0, 'dag':0, 'rl':0, 'plan':0, 'shard':0, 'la':0, 'logs':0, 'q_syn':'S=queue1,queue2;L=queue3,queue2', 'peq':'queue_arg1=pe_type1;queue_arg2=pe_type2' }
 
 #### templates:
 sge_header_template="""#!/bin/bash
@@ -26,12 +37,88 @@ sge_header_single_job=sge_header_template+"""#$ -e {logerr}
 """
 sge_header_array_job=sge_header_template+"""#$ -e {logerr}
 #$ -o {logout}
-#$ -t {range_str}
+#$ -t {range_str}{dependency}
+"""
+
+## array tasks dispatch. Default: each task scans the array file for its #N# line. 
+awk_exec_template="""cj_timed awk -v task_id=${task_var} -F"#" 'BEGIN{{pat="^#" task_id "# "}}$0 ~ pat{{exit system(substr($0, length($2)+4))}}' {outfile} || cj_status=$?
+"""
+## with -ix: commands are in a side file (one per line), and a second side file has their byte offsets in fixed-width records, so each task seeks directly to its command
+index_record_width=13   # 12 digits + newline
+indexed_exec_template="""cj_offset=$(dd if={index_file} bs={width} skip=$(( ${task_var} - 1 )) count=1 2>/dev/null)
+cj_cmd=$(tail -c +$(( 10#$cj_offset + 1 )) {cmds_file} | head -n 1)
+cj_timed bash -c "$cj_cmd" || cj_status=$?
+"""
+
+## with -xp: the lines of a job (each prefixed by its input index) are run by a pool of local processes, as many as the slots allocated
+parallel_exec_template="""cj_slots=${{NSLOTS:-${{SLURM_CPUS_PER_TASK:-{procs}}}}}
+xargs -d '\\n' -n 1 -P $cj_slots bash -c 'i=${{1%% *}}; bash -c "${{1#* }}" > {outfile}.$i.LOG {redirect_err}; s=$?; echo "$i $s" >> {outfile}.status; exit $s' cj_line <<'CJ_LINES'
+{lines}CJ_LINES
+if [ $? -ne 0 ]; then echo "cluster_job: some lines failed; exit status of each line is in {outfile}.status" >&2; fi
+"""
+
+## completion records, used to find failed jobs (-rf) and to summarize a run (-st). Each array task appends one line to ARRAYFILE.exit, 
+## each single job to the jobs.exit file in the jobs folder:    ID EXIT_STATUS START END MAX_RSS
+## ID is the task id or the job file; START and END are in epoch seconds; MAX_RSS is the peak resident memory in KB, measured by /usr/bin/time (- if not available)
+## Appends from different nodes are not atomic on NFS, so they are serialized with flock on the lock file of each .exit file (as for -la).
+## The measured command is followed by || cj_status=$? , so that a set -e in the -H header cannot exit before the record is written
+record_start_template="""cj_status=0; cj_start=$(date +%s); cj_rss_file=$(mktemp 2>/dev/null || echo /tmp/cj_rss.$$)
+cj_timed(){{ if [ -x /usr/bin/time ]; then /usr/bin/time -f %M -o $cj_rss_file "$@"; else "$@"; fi; }}
+"""
+record_end_template="""cj_rss=$(tail -n 1 $cj_rss_file 2>/dev/null || true); rm -f $cj_rss_file
+( flock 9 2>/dev/null || true; echo "{id} $cj_status $cj_start $(date +%s) ${{cj_rss:--}}" >> {exit_file} ) 9>> {exit_file}.lock
+"""
+## with -la: the output of each array task is captured in a temporary folder (local to the node, in $TMPDIR), then compressed and appended
+## to the archive ARRAYFILE.logs as two gzip members (stdout, stderr). Their position is appended to ARRAYFILE.logs.idx:  TASK OFFSET OUT_LENGTH ERR_LENGTH
+## Appends are serialized with flock on ARRAYFILE.logs.lock. The archive can be read by task with -logs, or all at once with zcat
+log_capture_start_line="""cj_log_dir=$(mktemp -d 2>/dev/null || {{ mkdir -p /tmp/cj_log.$$ && echo /tmp/cj_log.$$; }})
+{{
+"""
+log_capture_end_template="""}} > $cj_log_dir/out 2>{err_target}
+"""
+log_archive_template="""gzip -c $cj_log_dir/out > $cj_log_dir/out.gz; gzip -c $cj_log_dir/err > $cj_log_dir/err.gz
+( flock 9 2>/dev/null || true; cj_log_offset=$(stat -c %s {archive} 2>/dev/null || echo 0); cat $cj_log_dir/out.gz $cj_log_dir/err.gz >> {archive}
+  echo "${task_var} $cj_log_offset $(stat -c %s $cj_log_dir/out.gz) $(stat -c %s $cj_log_dir/err.gz)" >> {archive}.idx ) 9>> {archive}.lock
+rm -rf $cj_log_dir
+"""
+
+## single jobs: commands are in a block at the end of the job file, after its final exit. They are run by a child bash measured by cj_timed, 
+## which reads the block from the job file itself, so commands do not pass through its arguments or environment (limited to 128KB per string).
+## The -H header and -F footer lines are in the block too, so that their shell state (e.g. set -e, cd) applies to the commands.
+## Its status is that of its last failed command (or 0), or the argument of exit
+single_job_template=record_start_template+"""cj_timed bash <(sed -n '/^#cj_body$/,$p' "$0") || cj_status=$?
+"""+record_end_template+"""exit $cj_status
+"""
+single_job_body_template="""#cj_body
+cj_status=0; trap 'cj_status=$?' ERR
+{init}{cmd}
+{footer}exit $cj_status
 """
 
 sge_pe_template=  "\n#$ -pe {pe} {procs}"   ## for n of processors
 slurm_pe_template="\n#SBATCH -c {procs}"   
 
+## dependencies of arrays split by -max, with -chain. In slurm, chained arrays share their job name, and each runs after the previous one with this name is over
+sge_throttle_template="\n#$ -tc {tc}"     ## for max concurrent tasks in arrays (-tc). In slurm, this is a %K suffix of the array range
+sge_hold_template="\n#$ -hold_jid {names}"
+slurm_singleton_line="\n#SBATCH --dependency=singleton"
+
+## -sys local: job files are run on this machine by a local_runner, which reads these header lines
+local_header_template="""#!/bin/bash
+#LOCAL -N {name}
+#LOCAL -m {mem} {queue_line}{time_line}{additional_options}{cpus}
+"""
+local_header_single_job=local_header_template+"""#LOCAL -e {logerr}
+#LOCAL -o {logout}
+"""
+local_header_array_job=local_header_template+"""#LOCAL -e {logerr}
+#LOCAL -o {logout}
+#LOCAL -t {range_str}{dependency}
+"""
+local_pe_template="\n#LOCAL -c {procs}"
+local_throttle_template="\n#LOCAL -tc {tc}"
+local_hold_template="\n#LOCAL -hold_jid {names}"
+
 slurm_header_template="""#!/bin/bash       
 #SBATCH -J {name} {queue_line}{time_line}{additional_options}{cpus}
 #SBATCH --mail-user={email}
@@ -43,7 +130,7 @@ slurm_header_single_job=slurm_header_template+"""#SBATCH -e {logerr}
 """
 slurm_header_array_job= slurm_header_template+"""#SBATCH -e {logerr}
 #SBATCH -o {logout}
-#SBATCH -a {range_str}
+#SBATCH -a {range_str}{dependency}
 """
 
 
@@ -60,10 +147,31 @@ Usage #2 (clusters of jobs)     cluster_job.py input_file [output_folder] [job_n
 -i      +   input file. Use '-' for standard input
 -o      +   output folder. Default is input file name plus ".jbs/"
 -N      +   define name of jobs (numerical suffixes are added). Default is input file name
--sys    +   cluster system; possible values: "sge" (default) or "slurm"
+-sys    +   cluster system; possible values: "sge" (default), "slurm", or "local" to run the jobs on this machine (see below)
 -n_lines | -nl +  set this to have X lines of input commands per job. Turns off array mode
 -n_jobs  | -nj +  set this to have a number of jobs X. Overrides -n_lines and turns off array mode
 -qsub | -Q  submit the jobs with qsub (sge) or sbatch (slurm)
+-sm     +   submission mode, when not in array mode:  each (default): one qsub/sbatch call per job file
+            shell: submission commands are pipelined to a single persistent bash process
+            array: job files are not submitted one by one; a single array job (.batch) is submitted to run them all
+            pool:  job files are submitted concurrently by a pool of -sp workers
+-sp     +   number of concurrent submissions with -sm pool (default: 4)
+-rate   +   maximum number of submissions per second (default: 0, no limit)
+-retry  +   failed submissions are retried this many times, with exponential backoff (default: 3; not in -sm shell)
+-shard  +   not in array mode, place each job file and its logs in this many levels of subdirectories (e.g. 2: jobs_folder/3f/a2/NAME), 
+            named after the md5 of the job name, 256 per level; recommended for many thousands of jobs on shared filesystems.
+            The path of each job file is listed with its name in the jobs_manifest file
+-wt     +   number of threads writing (and submitting) job files, when not in array mode (default: 1)
+-inc        incremental mode, not in array mode: keep the existing jobs folder and its logs, and write (and submit) only the job files
+            which are new or whose content changed since the previous run. Content hashes are kept in file job_hashes in the jobs folder
+-rf     +   resubmit failed: scan this jobs folder from a finished run, and write (and submit, with -Q) an array with only the commands
+            of the array tasks or job files which did not exit successfully. Each array X with failures gets X.retry; failed single job 
+            files are run by a failed_jobs.batch array. This relies on the exit markers written by jobs: X.exit for arrays, jobs.exit for 
+            single jobs; tasks or jobs with no marker are considered failed. The job properties of the current command line are used
+-st     +   status: summarize the completion records of this jobs folder (exit status, wall time, peak memory of each array task 
+            and job file), then exit. Records are appended when tasks end: X.exit for arrays, jobs.exit for single jobs
+-resume     keep the existing jobs folder and its logs, and do not submit job files already accepted in a previous run.
+            Accepted submissions are recorded with their job ID in file submitted.ledger in the jobs folder
 
 ** Job properties:
 -q      +   queue name(s), comma separated; synonyms can be used (see -q_syn or run with -h default)
@@ -76,14 +184,41 @@ Usage #2 (clusters of jobs)     cluster_job.py input_file [output_folder] [job_n
 -H / -F +   file with header (-H) or footer (-F) command, executed in each job before or after input commands
 -joe        join std output and error logs; so that every job produce a single output file
 -sl         use single log for all jobs, instead of 1 out, 1 err per job
+-xp         not in array mode, run the lines of each job in parallel, with as many processes as slots allocated ($NSLOTS in sge,
+            $SLURM_CPUS_PER_TASK in slurm, or -p). Each line has its own logs (JOBFILE.INDEX.LOG/ERR, INDEX being the line in input), 
+            and its exit status is appended to JOBFILE.status
 -e          do not export the current environment in the job (i.e. don't use option -V in qsub)
 -email  +   email provided when submitting job
 -E      +   send an email in conditions determined by the argument. Multiple ones can be concatenated, e.g. -E abe
         b:  at the beginning of the job;          e:  end of the job; 
         a:  if aborted (or rescheduled in sge);   s:  suspended <sge only>;     v:  verbose, mails for anything
 -r     s-e  in array mode only, defines range of jobs executed (start-end). Wraps qsub option -t
+-max   +   split arrays into several array files of at most this many tasks each (NAME.1, NAME.2 ...), with their own side files and 
+            logs; the range of -r refers to all input lines. Use it to stay below the scheduler maximum array size (e.g. MaxArraySize in slurm)
+-tc    +   maximum number of tasks of each array running at the same time (rendered as -tc K in sge, or -a 1-N%K in slurm). 
+            Also applies to the arrays of -sm array and -rf. It is checked against the scheduler configuration, if readable
+-chain      with -max, each array is submitted to wait for the previous one to finish (-hold_jid in sge; --dependency=singleton in slurm)
+-dag        dependency graph mode: the input is split in stages, each declared by a line:   #stage NAME [after STAGE1,STAGE2 ...]
+            followed by its command lines. Every stage is written as an array (NAME is appended to the job name), which starts only 
+            when the arrays of the stages after which it is declared are over: through -hold_jid in sge, and --dependency=afterok in 
+            slurm (note that sge starts it also if they failed). Stages must be declared after those they depend on.
+            Arrays must be submitted in order: script submit_dag.sh in the jobs folder does so, if not using -qsub
+-la         in array mode only, log archive: instead of a .LOG and .ERR file per task, the output of each task is compressed and appended
+            to a single file per array (ARRAYFILE.logs), indexed by task (ARRAYFILE.logs.idx). Read them with -logs. Scheduler logs are discarded
+-logs   +   print the logs of the tasks of this array file, archived with -la; use -r to select a range of tasks. Then exit
+-ix         in array mode only, store commands in a side file (.cmds) with a fixed-width offset index (.idx), so that each
+            task reads its command with a seek, instead of scanning the whole array file (recommended for large arrays)
+Input is read as a stream: job files are written (and submitted) while input lines are still being read. 
+With -n_jobs the lines must be counted first: a file is read twice, standard input is spooled to a temporary file
 When array mode is off, options -n and -c are available to control dynamically job name and content. See advanced help with -h full
 
+** Packing lines by estimated runtime (not in array mode; the whole input is loaded in memory):
+-cost   +   python expression giving the estimated cost (e.g. runtime) of each line, evaluated like -n and -c; e.g. -cost "float(x.c)"
+-ch     +   history file with past runtimes: tab separated, with an input line and its runtime as last field. 
+            Lines not found get the average cost. -cost has priority if both are provided
+            With -cost or -ch, lines are distributed among the jobs (as many as with -nj or -nl) to balance their total estimated cost, 
+            rather than by count. Lines within a job keep their input order
+
 ** SGE system only:
 -pe     +   parallelization environment for SGE (default: smp); taken from -peq if provided
 -peq    +   defining which -pe to use based on the -q argument; format: "QUEUE_X:pe1;SYNONYM_Y:pe2"
@@ -91,10 +226,20 @@ When array mode is off, options -n and -c are available to control dynamically j
 ** Slurm system only:
 -srun       slurm only; prefix each command line by "srun "
 
+** Local system (-sys local):
+Job files are written as for a cluster, with #LOCAL header lines. With -qsub, they are run on this machine as they are written, 
+by a pool of processes: as many as cores divided by -p, and further limited so that the memory requested by running jobs (-m) fits 
+in the machine memory. Memory is a soft cap, used only to decide how many jobs run at once. Logs are written to the same paths as 
+in a cluster, array tasks get their id in $CJ_TASK_ID, and -tc, -chain and -dag dependencies are honoured. -q, -t, -E are ignored.
+The makespan (time from the first job start to the last job end) is reported at the end
+-rl     +   run locally the job and array files of this jobs folder, written with -sys local, in the order of its jobs_manifest
+
 ** Other options:
--so           options to submit, provided directly to qsub (sge) or sbatch (slurm). Use quotes, e.g. -so " -tc 5 "
+-so           options to submit, provided directly to qsub (sge) or sbatch (slurm). Use quotes, e.g. -so " -l h=node1 "
 -f            force overwrite of jobs folder if existing. By default, it prompts
 -qsyn   +     defining synonyms for -q, using format: "SYN_NAME=queue1;OTHER_SYN=queue2,queue3"
+-plan         dry run: compute the job files or arrays that would be written (lines per job, bytes, log files, scheduler calls,
+              estimated submission time) and print a summary, without writing or submitting anything
 -print_opt    prints default values for all options
 -h | --help   print this help and exit
               use "-h default" to learn how to customize cluster_job (set default values)
@@ -172,14 +317,583 @@ command_line_synonyms={'Q':'qsub', 'nj':'n_jobs', 'nl':'n_lines', 'force':'f',
 #########################################################
 ###### start main program function
 
+def read_command_lines(input_file_h, keep_stages=False):
+  """ Generator of the command lines in input, stripped; empty lines and comments (#) are skipped, except stage declarations (-dag) if keep_stages is True """
+  for line in input_file_h:
+    line=line.strip()
+    if line and (not line.startswith("#") or keep_stages and line.split()[0]==stage_marker):  yield line
+
+stage_marker='#stage'
+def read_stages(cmd_lines):
+  """ Splits the command lines of -dag into stages, declared by lines:  #stage NAME [after STAGE1,STAGE2 ...]
+  Yields [name, list of stages it depends on, iterator over its command lines] for each stage. Input is consumed as a stream: 
+  the command lines of a stage are skipped, if not consumed, when the next stage is requested """
+  cmd_lines=iter(cmd_lines)
+  declaration=next(cmd_lines, None)
+  while not declaration is None:
+    fields=declaration.split()
+    if fields[0]!=stage_marker or len(fields) not in [2, 4] or len(fields)==4 and fields[2]!='after':
+      raise notracebackException, 'ERROR in -dag mode, each stage must start with a line:  {} NAME [after STAGE1,STAGE2 ...]  ; found instead: {}'.format(stage_marker, declaration)
+    name=fields[1];   after=fields[3].split(',') if len(fields)==4 else []
+    next_declaration=[None]
+    def stage_commands(next_declaration=next_declaration):
+      for line in cmd_lines:
+        if line.split()[0]==stage_marker:
+          next_declaration[0]=line
+          return
+        yield line
+    commands=stage_commands()
+    yield [name, after, commands]
+    for line in commands: pass
+    declaration=next_declaration[0]
+
 class tab_line(str):
-  """ container class, gets tab separated fields from a input file"""
-  def __init__(self, line=None):
-    if line:
-      for index, field in enumerate(line.strip().split('\t')):
-        setattr(self, lowercase[index], field)
-    self.line=line
-  def __str__(self): return str(self.line)
+  """ container class, gets tab separated fields from a input file, as attributes x.a, x.b, x.c ...
+  Instances have no __dict__: fields are split only when one is first accessed, and the split of the last line used is cached at class level """
+  __slots__=()
+  field_index=dict( (letter, index) for index, letter in enumerate(lowercase) )
+  cache=[None, None]    ## [line, list of fields]
+  def __getattr__(self, name):
+    if not name in tab_line.field_index:    raise AttributeError, "tab_line has no attribute "+name
+    cache=tab_line.cache
+    if not cache[0] is self:
+      cache[0]=self
+      cache[1]=self.strip().split('\t')
+    try:                return cache[1][ tab_line.field_index[name] ]
+    except IndexError:  raise AttributeError, "tab_line has no field "+name+" (it has "+str(len(cache[1]))+")"
+  @property
+  def line(self):    return str.__str__(self)
+  def __str__(self): return str.__str__(self)
+
+def iter_chunks(iterable, size):
+  """ Yields consecutive iterators over chunks of at most size items of iterable, which is consumed as a stream. Each chunk must be consumed before requesting the next """
+  iterator=iter(iterable)
+  for first in iterator:
+    yield chain([first], islice(iterator, size-1))
+
+def parse_job_id(reply):
+  """ Returns the job ID in the reply of qsub ("Your job 123 (...) has been submitted", or "Your job-array 123.1-10:1 ...") or sbatch ("Submitted batch job 123"), or '' if not found """
+  m=re.search(r'job(?:-array)?\s+(\d+)', reply)
+  if m: return m.group(1)
+  return ''
+
+def count_groups(cmd_lines, n_lines_per_job):
+  """ Generator of the lists of (index, line) to be included in each job, when splitting by count; index starts at 1. n_lines_per_job may be fractional (with -n_jobs) """
+  group=[];  n_job=1
+  for index, line in enumerate(cmd_lines, 1):
+    group.append( (index, line) )
+    if index >= n_lines_per_job*n_job:
+      yield group
+      group=[];  n_job+=1
+  if group: yield group
+
+def pack_lines(costs, n_bins):
+  """ Assigns items with the given costs to at most n_bins bins, balancing the total cost per bin (greedy, longest processing time first). 
+  Returns the list of bins, each a sorted list of item indexes (starting at 0); bins are sorted by their first item """
+  heap=[ (0.0, b) for b in range(n_bins) ]
+  bins=[ [] for b in range(n_bins) ]
+  for i in sorted(range(len(costs)), key=costs.__getitem__, reverse=True):
+    load, b = heapq.heappop(heap)
+    bins[b].append(i)
+    heapq.heappush(heap, (load+costs[i], b))
+  bins=[ sorted(items) for items in bins if items ]
+  bins.sort()
+  return bins
+
+def load_cost_history(history_file):
+  """ Reads a tab separated file with an input line and its runtime as last field; returns a dict line -> runtime """
+  history={}
+  for line in open(history_file):
+    if not line.strip() or line.startswith('#'): continue
+    cline, runtime = line.rstrip('\n').rsplit('\t', 1)
+    history[cline.strip()]=float(runtime)
+  return history
+
+def shard_path(folder, name, levels):
+  """ Returns the path of file name inside folder, in levels of subdirectories named by the first hex digits of the md5 of name (256 per level) """
+  digest=md5(name).hexdigest()
+  return folder+join([ digest[2*level:2*level+2]+'/' for level in range(levels) ], '')+name
+
+def job_file_logs(job_file):
+  """ Reads the header of a single job file, returns its output and error log files as [logout, logerr] """
+  logs={}
+  for line in open(job_file):
+    if not line.startswith('#'): break
+    fields=line.split()
+    if len(fields)==3 and fields[0] in ['#$', '#SBATCH', '#LOCAL'] and fields[1] in ['-o', '-e']:  logs[fields[1]]=fields[2]
+  return [ logs.get('-o', job_file+'.LOG'), logs.get('-e', job_file+'.ERR') ]
+
+def scheduler_array_limits(sys_name):
+  """ Reads the array limits in the scheduler configuration, with qconf -sconf (sge) or scontrol show config (slurm). 
+  Returns a dictionary with keys max_tasks (max number of tasks per array; sge), max_index (max task index; slurm) and max_running (max tasks of an array running at once; sge).
+  Values are None if unlimited, or if the configuration can't be read (e.g. the scheduler commands are not available in this machine) """
+  limits={'max_tasks':None, 'max_index':None, 'max_running':None}
+  if not sys_name in ['sge', 'slurm']:  return limits
+  if   sys_name=='sge':    status, out = bash('qconf -sconf')
+  elif sys_name=='slurm':  status, out = bash('scontrol show config')
+  if status: return limits
+  for line in out.split('\n'):
+    fields=line.replace('=', ' ').split()
+    if len(fields)!=2 or not fields[1].isdigit() or not int(fields[1]): continue
+    if   fields[0]=='max_aj_tasks':      limits['max_tasks']=int(fields[1])
+    elif fields[0]=='max_aj_instances':  limits['max_running']=int(fields[1])
+    elif fields[0]=='MaxArraySize':      limits['max_index']=int(fields[1])-1
+  return limits
+
+class header_cache(object):
+  """ Header template pre-rendered once with all values constant within a run. 
+  The result is kept as a %-interpolation string, in which only the per-job fields are filled for each job: render takes their values in the order of per_job_fields """
+  def __init__(self, template, per_job_fields, **constant_values):
+    placeholders=dict( (field, '\0'+field+'\0') for field in per_job_fields )
+    placeholders.update(constant_values)
+    pieces=re.split('\0(\w+)\0', template.format(**placeholders))   ## constant text at even indexes, field names at odd indexes
+    self.template=join( [ piece.replace('%', '%%') if not index%2 else '%s'  for index, piece in enumerate(pieces)], '')
+    self.order=[ per_job_fields.index(field) for field in pieces[1::2] ]
+    if self.order==range(len(per_job_fields)): self.order=None   ## fields appear once each, in the same order: values can be used directly
+  def render(self, *values):
+    if self.order is None:   return self.template % values
+    return self.template % tuple([values[index] for index in self.order])
+
+class job_submitter(object):
+  """ Submits job files with qsub (sge) or sbatch (slurm), and keeps track of throughput. 
+  In mode "each", every submission is a separate bash call, retried with exponential backoff on errors.
+  In mode "shell", submission commands are written to a single persistent bash process, without waiting for the scheduler reply;
+  replies are collected by a reader thread, and checked at each submission and when closing.
+  In mode "pool", a pool of worker threads runs submissions concurrently, optionally capped to a number of submissions per second; 
+  submissions still failing after all retries are reported when closing, instead of aborting the batch.
+  If a ledger file is provided, accepted job files are appended to it with their job ID, and those already listed are not submitted again """
+  exit_marker='#cj_exit#'
+  def __init__(self, sys_name, add_options='', mode='each', ledger_file=None, n_workers=1, rate=0, max_retries=0, retry_delay=1.0):
+    self.sys_name=sys_name
+    self.add_options=add_options
+    self.mode=mode
+    self.n_calls=0
+    self.n_jobs=0
+    self.n_skipped=0
+    self.start_time=None
+    self.max_retries=max_retries
+    self.retry_delay=retry_delay
+    self.lock=threading.Lock()
+    self.failed=[]    # list of [job_file, output] of submissions which failed all retries, in mode pool
+    ## ledger
+    self.ledger_file=ledger_file
+    self.accepted={}  # job_file -> job_id
+    if ledger_file and is_file(ledger_file):
+      for line in open(ledger_file):
+        job_file, job_id=line.rstrip('\n').split('\t')
+        self.accepted[job_file]=job_id
+    self.ledger_h=open(ledger_file, 'a') if ledger_file else None
+    ## rate cap
+    self.min_interval=1.0/rate if rate else 0
+    self.next_slot=0
+    if mode=='shell':
+      self.shell=bash_pipe('bash', stdin='PIPE', return_popen=1)
+      self.submitted=[]   # list of [job_file, command]
+      self.replies=[]     # list of [exit_status, output]
+      self.reply_lines=[]
+      self.reader=threading.Thread(target=self.read_replies)
+      self.reader.daemon=True
+      self.reader.start()
+    elif mode=='pool':
+      self.queue=Queue.Queue(maxsize=2*n_workers)
+      self.workers=[threading.Thread(target=self.work) for i in range(n_workers)]
+      for w in self.workers:
+        w.daemon=True
+        w.start()
+
+  def submit_command(self, job_file, options=''):
+    if   self.sys_name=='sge':    return 'qsub   {} {} {} '.format(self.add_options, options, job_file)
+    elif self.sys_name=='slurm':  return 'sbatch {} {} {} '.format(self.add_options, options, job_file)
+
+  def submit(self, job_file, n_jobs=1, options=''):
+    """ Submits a job file (n_jobs is the number of tasks, for arrays), adding options to those of the submitter. 
+    Returns the job ID in mode "each", or the one in the ledger if the file is found there; None in other modes """
+    if job_file in self.accepted:
+      self.n_skipped+=1
+      return self.accepted[job_file]
+    if self.start_time is None: self.start_time=time.time()
+    self.n_calls+=1
+    self.n_jobs+=n_jobs
+    if self.mode=='shell':
+      self.check_replies()
+      command=self.submit_command(job_file, options)
+      self.submitted.append([job_file, command])
+      print >> self.shell.stdin, command+' 2>&1 ; echo "'+self.exit_marker+' $?"'
+      self.shell.stdin.flush()
+    elif self.mode=='pool':
+      self.queue.put([job_file, options])
+    else:
+      exit_status, output = self.run_with_retries(job_file, options)
+      if exit_status!=0:  raise Exception, 'COMMAND: ' + self.submit_command(job_file, options)+' ERROR: "'+output+' "'
+      return self.accept(job_file, output)
+
+  def forget(self, job_file):
+    """ Removes a job file from those accepted, so that it is submitted again """
+    with self.lock:  self.accepted.pop(job_file, None)
+
+  def accept(self, job_file, reply):
+    """ Records a successful submission in the ledger; returns the job ID """
+    job_id=parse_job_id(reply)
+    with self.lock:
+      self.accepted[job_file]=job_id
+      if self.ledger_h:
+        print >> self.ledger_h, job_file+'\t'+job_id
+        self.ledger_h.flush()
+    return job_id
+
+  def wait_slot(self):
+    """ Blocks until the next submission is allowed by the rate cap """
+    if not self.min_interval: return
+    with self.lock:
+      now=time.time()
+      slot=max(now, self.next_slot)
+      self.next_slot=slot+self.min_interval
+    if slot>now: time.sleep(slot-now)
+
+  def run_with_retries(self, job_file, options=''):
+    """ Runs the submission command, retrying with exponential backoff if it fails; returns [exit_status, output] of the last attempt """
+    command=self.submit_command(job_file, options)
+    for attempt in range(self.max_retries+1):
+      if attempt:  time.sleep( self.retry_delay * 2**(attempt-1) )
+      self.wait_slot()
+      exit_status, output = bash(command)
+      if exit_status==0: break
+    return [exit_status, output]
+
+  def work(self):
+    while True:
+      item=self.queue.get()
+      try:
+        if item is None: break
+        job_file, options = item
+        exit_status, output = self.run_with_retries(job_file, options)
+        if exit_status==0:    self.accept(job_file, output)
+        else:
+          with self.lock:     self.failed.append([job_file, output])
+      finally:
+        self.queue.task_done()
+
+  def read_replies(self):
+    for line in iter(self.shell.stdout.readline, ''):
+      if line.startswith(self.exit_marker):
+        exit_status=int(line.split()[1])
+        output=join(self.reply_lines, '')
+        if exit_status==0:  self.accept(self.submitted[len(self.replies)][0], output)
+        self.replies.append( [exit_status, output] )
+        self.reply_lines=[]
+      else:  self.reply_lines.append(line)
+
+  def check_replies(self):
+    """ Raises an exception, as bbash would, if any submission in shell mode failed. Submissions already piped to the shell are completed first """
+    for index, (exit_status, output) in enumerate(self.replies):
+      if exit_status!=0:
+        self.close_shell()
+        raise Exception, 'COMMAND: ' + self.submitted[index][1]+' ERROR: "'+output.rstrip()+' "'
+
+  def close_shell(self):
+    if not self.shell.stdin.closed:
+      self.shell.stdin.close()
+      self.reader.join()
+      self.shell.wait()
+
+  def close(self):
+    """ Waits for all pending submissions, and reports throughput. In mode pool, raises a notracebackException if any submission failed """
+    if self.mode=='shell':
+      self.close_shell()
+      self.check_replies()
+    elif self.mode=='pool':
+      for w in self.workers: self.queue.put(None)
+      for w in self.workers: w.join()
+    if self.ledger_h: self.ledger_h.close()
+    if self.n_skipped:
+      write('Skipped {} job files already submitted according to ledger {}'.format(self.n_skipped, self.ledger_file), 1)
+    if self.n_calls:
+      elapsed=time.time()-self.start_time
+      write('Submitted {j} jobs with {c} scheduler call{s} in {t:.1f}s ({r:.1f} jobs/s)'.format(j=self.n_jobs, c=self.n_calls, s='s' if self.n_calls>1 else '', 
+                                                                                           t=elapsed, r=self.n_jobs/max(elapsed, 1e-6)), 1)
+    if self.failed:
+      for job_file, output in self.failed:  printerr('ERROR submission failed for '+job_file+' : '+output.strip(), 1)
+      raise notracebackException, 'ERROR {n} submissions failed after {r} retries. Run again with -resume to submit only the job files missing from ledger {l}'.format(n=len(self.failed), r=self.max_retries, l=self.ledger_file)
+
+def machine_memory():
+  """ Returns the total memory of this machine in GB, or None if it can't be read """
+  if not is_file('/proc/meminfo'): return None
+  for line in open('/proc/meminfo'):
+    if line.startswith('MemTotal:'):  return int(line.split()[1])/1024.0**2
+
+class local_runner(object):
+  """ Stand-in scheduler for -sys local, with the same interface as job_submitter: job files are run on this machine by a pool of worker threads, 
+  each running one bash process at a time. Array files are run once per task, with the task id in $CJ_TASK_ID.
+  The pool has as many workers as cores divided by the processors per job, limited also so that the memory requested by running jobs fits in 
+  the machine memory (soft cap: the memory actually used is not enforced). Job files are read for their #LOCAL header lines: 
+  logs (-o, -e; $TASK_ID is replaced by the task id), task range (-t), max tasks running (-tc), and job names to wait for (-hold_jid).
+  Jobs with -hold_jid are submitted only when all tasks of those jobs are over, so submit blocks until then """
+  task_var='CJ_TASK_ID'
+  def __init__(self, procs_per_job=1, mem_per_job=0, n_workers=None):
+    if n_workers is None:
+      n_workers=max(1, multiprocessing.cpu_count()/max(1, procs_per_job))
+      total_mem=machine_memory()
+      if mem_per_job and total_mem:  n_workers=min(n_workers, max(1, int(total_mem/mem_per_job)))
+    self.n_workers=n_workers
+    self.procs_per_job=max(1, procs_per_job)
+    self.accepted={}   # kept for compatibility with job_submitter; local runs are not recorded in a ledger
+    self.n_jobs=0
+    self.n_failed=0
+    self.job_time=0.0
+    self.start_time=None
+    self.end_time=None
+    self.condition=threading.Condition()
+    self.running={}    # job name -> number of its tasks not finished yet
+    self.queue=Queue.Queue()
+    self.workers=[threading.Thread(target=self.work) for i in range(n_workers)]
+    for w in self.workers:
+      w.daemon=True
+      w.start()
+
+  def submit(self, job_file, n_jobs=1, options=''):
+    """ Queues a job file (all its tasks, for arrays) to be run; returns its job name. options are ignored """
+    header={}
+    for line in open(job_file):
+      if not line.startswith('#'): break
+      fields=line.split(None, 2)
+      if len(fields)==3 and fields[0]=='#LOCAL':  header[fields[1]]=fields[2].strip()
+    if not header:  raise notracebackException, 'ERROR job file was not written with -sys local: '+job_file
+    name=header.get('-N', job_file)
+    if '-hold_jid' in header:
+      hold_names=header['-hold_jid'].split(',')
+      with self.condition:
+        while any(self.running.get(hold_name) for hold_name in hold_names):  self.condition.wait(1)
+    if '-t' in header:   
+      s,e = map(int, header['-t'].split('-'))
+      tasks=range(s, e+1)
+    else:                tasks=[None]
+    throttle=threading.Semaphore(int(header['-tc']))  if '-tc' in header  else None
+    with self.condition:
+      self.running[name]=self.running.get(name, 0)+len(tasks)
+      if self.start_time is None: self.start_time=time.time()
+    for task in tasks:
+      self.queue.put([job_file, name, task, header.get('-o', job_file+'.LOG'), header.get('-e', job_file+'.ERR'), throttle])
+    return name
+
+  def forget(self, job_file):
+    pass
+
+  def run(self, job_file, task, logout, logerr):
+    """ Runs a job file, or one of its tasks, redirecting its output to logs; returns its exit status """
+    env=dict(os.environ)
+    env['NSLOTS']=str(self.procs_per_job)
+    if not task is None:
+      env[self.task_var]=str(task)
+      logout=logout.replace('$TASK_ID', str(task));   logerr=logerr.replace('$TASK_ID', str(task))
+    out_h=open(logout, 'a')
+    err_h=out_h if logerr==logout else open(logerr, 'a')
+    try:     return subprocess.call(['bash', job_file], stdout=out_h, stderr=err_h, env=env)
+    finally:
+      out_h.close()
+      if not err_h is out_h: err_h.close()
+
+  def work(self):
+    while True:
+      item=self.queue.get()
+      try:
+        if item is None: break
+        job_file, name, task, logout, logerr, throttle = item
+        if throttle: throttle.acquire()
+        start=time.time()
+        try:      exit_status=self.run(job_file, task, logout, logerr)
+        except OSError:  exit_status=-1
+        finally:
+          if throttle: throttle.release()
+        with self.condition:
+          self.n_jobs+=1
+          self.job_time+=time.time()-start
+          self.end_time=time.time()
+          if exit_status:  self.n_failed+=1
+          self.running[name]-=1
+          self.condition.notify_all()
+      finally:
+        self.queue.task_done()
+
+  def close(self):
+    """ Waits for all jobs to finish, and reports the makespan """
+    for w in self.workers: self.queue.put(None)
+    for w in self.workers: w.join()
+    if self.n_jobs:
+      makespan=self.end_time-self.start_time
+      write('Ran {j} jobs locally with {w} workers: makespan {m:.1f}s, total job time {t:.1f}s ({r:.1f} jobs/s)'.format(j=self.n_jobs, w=self.n_workers, m=makespan, 
+                                                                                                                t=self.job_time, r=self.n_jobs/max(makespan, 1e-6)), 1)
+    if self.n_failed:
+      printerr('WARNING {n} jobs exited with an error; see -st and the logs'.format(n=self.n_failed), 1)
+
+class job_writer(object):
+  """ Writes job files, and submits them through a job_submitter if requested. 
+  With n_threads>1, files are written (and submitted) by a pool of threads fed through a bounded queue, so that creating many files is limited by filesystem parallelism, not by the latency of each file creation.
+  Errors occurring in the threads are raised in the main thread at the next call """
+  def __init__(self, submitter=None, n_threads=1):
+    self.submitter=submitter
+    self.n_threads=n_threads
+    self.submit_lock=threading.Lock()
+    self.error=None
+    if n_threads>1:
+      self.queue=Queue.Queue(maxsize=4*n_threads)
+      self.threads=[threading.Thread(target=self.work) for i in range(n_threads)]
+      for t in self.threads:
+        t.daemon=True
+        t.start()
+
+  def write(self, text, outfile, submit=False):
+    if self.n_threads>1:
+      self.check_error()
+      self.queue.put( (text, outfile, submit) )
+    else:  self.write_now(text, outfile, submit)
+
+  def write_now(self, text, outfile, submit=False):
+    write_to_file(text, outfile)
+    if submit:
+      with self.submit_lock:  self.submitter.submit(outfile)
+
+  def work(self):
+    while True:
+      item=self.queue.get()
+      try:
+        if item is None: break
+        if not self.error:  self.write_now(*item)
+      except Exception:
+        self.error=sys.exc_info()
+      finally:
+        self.queue.task_done()
+
+  def check_error(self):
+    if self.error:  raise self.error[0], self.error[1], self.error[2]
+
+  def close(self):
+    """ Waits until all files are written (and submitted) """
+    if self.n_threads>1:
+      for t in self.threads: self.queue.put(None)
+      for t in self.threads: t.join()
+      self.check_error()
+
+plan_call_latency=0.2   ## seconds per qsub/sbatch call assumed by -plan to estimate submission time
+
+class run_plan(object):
+  """ Layout of a run computed without writing any file (-plan): job and array files, their lines and bytes, log files and scheduler calls """
+  def __init__(self):
+    self.n_jobs=0;  self.n_arrays=0;  self.n_tasks=0
+    self.n_files=0; self.n_logs=0;    self.n_bytes=0;  self.n_calls=0;  self.n_dirs=0
+    self.lines_per_job={}   # number of lines -> number of job files with that many
+  def add_job(self, n_lines, n_bytes, n_logs, submitted):
+    self.n_jobs+=1;  self.n_files+=1;  self.n_bytes+=n_bytes;  self.n_logs+=n_logs;  self.n_calls+=int(submitted)
+    self.lines_per_job[n_lines]=self.lines_per_job.get(n_lines, 0)+1
+  def add_array(self, n_tasks, n_files, n_bytes, n_logs, submitted):
+    self.n_arrays+=1;  self.n_tasks+=n_tasks;  self.n_files+=n_files;  self.n_bytes+=n_bytes;  self.n_logs+=n_logs;  self.n_calls+=int(submitted)
+  def report(self, mode='each', n_workers=1, rate=0):
+    """ Prints the summary. Submission time is estimated from the number of scheduler calls, assuming plan_call_latency seconds per call """
+    write('Plan (nothing was written):', 1)
+    if self.n_jobs:
+      write('  job files:     {}'.format(self.n_jobs), 1)
+      counts=sorted(self.lines_per_job)
+      n_lines=sum(n*self.lines_per_job[n] for n in counts)
+      write('  lines per job: min {} max {} mean {:.2f}'.format(counts[0], counts[-1], n_lines/float(self.n_jobs)), 1)
+      if len(counts)<=5:  write('                 '+join(['{} jobs with {} lines'.format(self.lines_per_job[n], n) for n in counts], '; '), 1)
+    if self.n_arrays:
+      write('  arrays:        {} with {} tasks in total'.format(self.n_arrays, self.n_tasks), 1)
+    write('  files written: {} ({} bytes) plus up to {} log files'.format(self.n_files, self.n_bytes, self.n_logs), 1)
+    if self.n_dirs:  write('  job subdirectories: {}'.format(self.n_dirs), 1)
+    if self.n_calls:
+      seconds=self.n_calls*plan_call_latency
+      if mode=='pool':  seconds/=n_workers
+      if rate:          seconds=max(seconds, self.n_calls/rate)
+      write('  submission:    {} scheduler calls, about {:.1f}s (assuming {}s per call)'.format(self.n_calls, seconds, plan_call_latency), 1)
+
+class record_stats(object):
+  """ Accumulates the completion records (see record_end_template) of a set of tasks or jobs: counts, wall times, peak memory """
+  def __init__(self):
+    self.n=0;  self.n_records=0;  self.n_ok=0;  self.n_failed=0
+    self.wall_tot=0;  self.wall_max=0;  self.rss_max=None
+  def add_record(self, fields):
+    """ Adds the timings of a record, as split line. Exit status is counted separately by the caller, only for the last record of each task """
+    self.n_records+=1
+    wall=int(fields[3])-int(fields[2])
+    self.wall_tot+=wall;  self.wall_max=max(self.wall_max, wall)
+    if fields[4].isdigit():  self.rss_max=max(self.rss_max, int(fields[4]))
+  def add_stats(self, other):
+    for k in ['n', 'n_ok', 'n_failed', 'n_records', 'wall_tot']: setattr(self, k, getattr(self, k)+getattr(other, k))
+    self.wall_max=max(self.wall_max, other.wall_max);  self.rss_max=max(self.rss_max, other.rss_max)
+  def summary(self):
+    out='{:>7} ok {:>7} failed {:>7} no record'.format(self.n_ok, self.n_failed, self.n-self.n_ok-self.n_failed)
+    if self.n_records: out+='   wall time mean {:.0f}s max {}s'.format(self.wall_tot/float(self.n_records), self.wall_max)
+    if not self.rss_max is None:   out+='   peak memory {:.1f}MB'.format(self.rss_max/1024.0)
+    return out
+
+def run_status(output_folder):
+  """ Prints a summary of the completion records of a jobs folder (-st), reading each .exit file once, in the order of its jobs_manifest """
+  output_folder=Folder(output_folder)
+  if not is_file(output_folder+'jobs_manifest'): raise notracebackException, "ERROR jobs folder not found, or missing its jobs_manifest file: "+str(output_folder)
+  manifest=[ line.rstrip('\n').split('\t') for line in open(output_folder+'jobs_manifest') ]
+  total=record_stats()
+  for entry in manifest:
+    if entry[0]=='job': continue
+    array_file=entry[1];  s,e = map(int, entry[2].split('-'))
+    stats=record_stats();  stats.n=e-s+1
+    ## task status from their last record: 0 no record, 1 ok, 2 failed
+    task_status=bytearray(e+1)
+    if is_file(array_file+'.exit'):
+      for line in open(array_file+'.exit'):
+        fields=line.split()
+        task_status[int(fields[0])]= 1 if fields[1]=='0' else 2
+        if len(fields)>=5: stats.add_record(fields)
+    stats.n_ok=task_status.count('\x01');  stats.n_failed=task_status.count('\x02')
+    write('{:<8} {:<24} {}'.format(entry[0], base_filename(array_file), stats.summary()), 1)
+    ## retried arrays: only their successful tasks count in total, the failed ones are counted through the .retry array
+    if entry[0]=='retried':  stats.n=stats.n_ok;  stats.n_failed=0
+    ## batch arrays (-sm array, and failed_jobs.batch of -rf) run job files, which are counted through jobs.exit
+    if entry[0]!='batch':    total.add_stats(stats)
+
+  jobs=[ entry[1] for entry in manifest if entry[0]=='job' ]
+  if jobs:
+    stats=record_stats();  stats.n=len(jobs)
+    job_status={}
+    if is_file(output_folder+'jobs.exit'):
+      for line in open(output_folder+'jobs.exit'):
+        fields=line.split()
+        job_status[fields[0]]= fields[1]=='0'
+        if len(fields)>=5: stats.add_record(fields)
+    stats.n_ok=sum( 1 for job_file in jobs if job_status.get(job_file) is True )
+    stats.n_failed=sum( 1 for job_file in jobs if job_status.get(job_file) is False )
+    write('{:<8} {:<24} {}'.format('jobs', '{} job files'.format(len(jobs)), stats.summary()), 1)
+    total.add_stats(stats)
+  write('{:<8} {:<24} {}'.format('total', '', total.summary()), 1)
+
+def print_task_logs(array_file, task_range=None):
+  """ Prints the logs of array tasks archived with -la, using the index file to read only the records of the tasks in task_range ("start-end"; all if None).
+  If a task was run more than once, its last record is used """
+  if not is_file(array_file+'.logs.idx'): raise notracebackException, "ERROR log archive index not found: "+array_file+'.logs.idx  ; was the array written with -la, and did its tasks run?'
+  s,e = map(int, task_range.split('-'))  if task_range  else  (1, None)
+  records={}   # task -> [offset, out_length, err_length]
+  for line in open(array_file+'.logs.idx'):
+    fields=map(int, line.split())
+    if fields[0]>=s and (e is None or fields[0]<=e):  records[fields[0]]=fields[1:]
+  archive_h=open(array_file+'.logs', 'rb')
+  for task in sorted(records):
+    offset, out_length, err_length = records[task]
+    archive_h.seek(offset)
+    for stream, length in [('stdout', out_length), ('stderr', err_length)]:
+      if not length: continue     ## with -joe, stderr is in stdout
+      text=zlib.decompress(archive_h.read(length), 16+zlib.MAX_WBITS)   ## gzip member
+      write('### task {} {}'.format(task, stream), 1)
+      sys.stdout.write(text)
+  archive_h.close()
+
+def run_local(output_folder, procs_per_job, mem_per_job):
+  """ Runs on this machine the job and array files listed in the jobs_manifest of a jobs folder (-rl), in order, with a local_runner. 
+  Arrays retried by -rf and batch arrays of -sm array are skipped, since their commands are also in other entries """
+  output_folder=Folder(output_folder)
+  if not is_file(output_folder+'jobs_manifest'): raise notracebackException, "ERROR jobs folder not found, or missing its jobs_manifest file: "+str(output_folder)
+  runner=local_runner(procs_per_job=procs_per_job, mem_per_job=mem_per_job)
+  for line in open(output_folder+'jobs_manifest'):
+    entry=line.rstrip('\n').split('\t')
+    if entry[0] in ['job', 'array']:  runner.submit(entry[1])
+  runner.close()
 
 def main(args={}):
 #########################################################
@@ -189,12 +903,33 @@ def main(args={}):
   else:  opt=args
   set_MMlib_var('opt', opt)
 
-  if not opt['sys'] in ['sge', 'slurm']:    raise notracebackException, 'ERROR -sys  must be one of either sge, slurm'
+  if not opt['sys'] in ['sge', 'slurm', 'local']:    raise notracebackException, 'ERROR -sys  must be one of either sge, slurm, local'
+  if not opt['sm'] in ['each', 'shell', 'array', 'pool']:    raise notracebackException, 'ERROR -sm  must be one of either each, shell, array, pool'
+  if opt['chain'] and not opt['max']:    raise notracebackException, 'ERROR option -chain requires -max'
+  try:      max_tasks, max_running = int(opt['max']), int(opt['tc'])
+  except ValueError:   raise notracebackException, 'ERROR options -max and -tc must be integers'
+  if max_tasks<0 or max_running<0:       raise notracebackException, 'ERROR options -max and -tc must be positive integers'
+  if max_running and (' -tc ' in ' '+opt['so']+' ' or '%' in opt['so']):  raise notracebackException, 'ERROR option -tc is provided, a concurrency limit must not be set also in -so'
+  array_limits=scheduler_array_limits(opt['sys']) if max_tasks or max_running or opt['qsub'] else {}
+  if max_running and array_limits['max_running'] and max_running>array_limits['max_running']:
+    raise notracebackException, 'ERROR option -tc is {} but the scheduler allows at most {} running tasks per array (max_aj_instances)'.format(max_running, array_limits['max_running'])
+  if max_tasks and (array_limits['max_tasks'] and max_tasks>array_limits['max_tasks'] or array_limits['max_index'] and max_tasks>array_limits['max_index']):
+    raise notracebackException, 'ERROR option -max is {} but the scheduler allows at most {} tasks per array'.format(max_tasks, array_limits['max_tasks'] or array_limits['max_index'])
   write('   --['); write('{:^50}'.format( 'cluster_job v{ver} ({s})'.format(ver=__version__, s=opt['sys']) ),  how='reverse'); write(']--', 1)
 
+  if opt['st']:  return run_status(opt['st'])
+  if opt['rl']:  return run_local(opt['rl'], int(opt['p']), float(opt['m']))
+  if opt['logs']:  return print_task_logs(abspath(opt['logs']), opt['r'])
+  planning=bool(opt['plan'])
+  if planning and opt['rf']:   raise notracebackException, 'ERROR option -plan is not available with -rf'
+
   #checking input
   global input_file;   input_file=opt['i'];
-  if input_file=='-':  input_file_h=sys.stdin
+  if opt['rf']:
+    ## resubmit-failed mode: no input is read. The jobs folder of a previous run is scanned, after setting up job properties
+    output_folder=opt['rf']
+    if not is_file(Folder(output_folder)+'jobs_manifest'): raise notracebackException, "ERROR jobs folder not found, or missing its jobs_manifest file: "+str(output_folder)
+  elif input_file=='-':  input_file_h=sys.stdin
   else:
     if input_file==1: raise notracebackException, "ERROR you must specify an input file with -i"
     check_file_presence(input_file, 'input_file', notracebackException)
@@ -215,60 +950,88 @@ def main(args={}):
       queue, pe =assign_piece.split('=') 
       pe_table[queue]=pe
 
-  ### Reading input file
-  cmd_lines= [ line.strip() for line in input_file_h if line.strip() and not line.strip().startswith("#") ]    ## loading whole file
-  # determining number of jobs, number of lines
-  tot_lines=len(cmd_lines)
-#  single_job_mode=False
-  if tot_lines==0:    raise notracebackException, "ERROR input file is empty!"
-  if tot_lines==1:
-    array_mode=False; n_lines_per_job=1; n_jobs=1
-  elif not opt['n_lines'] and not opt['n_jobs']:
-    array_mode=True
-    #if tot_lines==1: single_job_mode=True
+  if opt['rf']:    array_mode=True
   else:
-    array_mode=False
-    if opt['r']: raise notracebackException, "ERROR option -r (job range in array) available only in array mode! options -nl and -nj must be inactive (or set to zero) to enter array mode"
-    if opt['n_jobs']:   n_lines_per_job= float(  tot_lines ) / int(opt['n_jobs'])
-    if opt['n_lines']:  n_lines_per_job= opt['n_lines']
-    n_jobs=  (tot_lines-1) / n_lines_per_job +1
-    #if n_jobs==1: single_job_mode=True
-
-  global name_e;  name_e=opt['n'] ;    global cmd_e; cmd_e=opt['c']
-
-  output_folder=opt['o']
-  #if single_job_mode:
-  #  if not output_folder: single_output_file= input_file+'.jb' #....
-  if not output_folder:    #raise Exception, "ERROR you must specify an expression for output files (option -o) ; please run -h for more information"
-    output_folder= input_file+'.jbs'
-
-  ######### names and commands including expressions
-  if not cmd_e is None and array_mode: raise notracebackException, 'ERROR -c cmdEXPR is not available in job array mode. Use either  -nl number_of_lines   or   -nj number_of_jobs  ; please run with -h for more information'
-  if not array_mode and cmd_e is None: cmd_e="x"  # standing for: execute full line
-  if not name_e is None:
-    if array_mode: raise notracebackException, 'ERROR -n nameEXPR is not available in job array mode. Use either  -nl number_of_lines   or   -nj number_of_jobs ; please run with -h for more information'
-  else:
-    if opt['N']:   prefix_name=opt['N'].rstrip('.')
+    ### Reading input file, as a stream. We peek at the first two lines to decide the mode
+    cmd_lines=read_command_lines(input_file_h, keep_stages=opt['dag'])
+    first_lines=list(islice(cmd_lines, 2))
+    cmd_lines=chain(first_lines, cmd_lines)
+    # determining number of jobs, number of lines
+    if not first_lines:    raise notracebackException, "ERROR input file is empty!"
+    if opt['dag']:
+      if opt['n_lines'] or opt['n_jobs'] or opt['r'] or opt['chain']: raise notracebackException, "ERROR options -nl, -nj, -r and -chain are not available in -dag mode, in which each stage is written as an array"
+      array_mode=True
+    elif len(first_lines)==1:
+      array_mode=False; n_lines_per_job=1
+    elif not opt['n_lines'] and not opt['n_jobs']:
+      array_mode=True
+    else:
+      array_mode=False
+      if opt['r']: raise notracebackException, "ERROR option -r (job range in array) available only in array mode! options -nl and -nj must be inactive (or set to zero) to enter array mode"
+      if not opt['cost'] is None or opt['ch']:
+        ## packing mode: all lines are needed to balance jobs
+        cmd_lines=list(cmd_lines)
+        tot_lines=len(cmd_lines)
+        if opt['n_jobs']:   n_lines_per_job= float(  tot_lines ) / int(opt['n_jobs'])
+      elif opt['n_jobs']:
+        ## total number of lines is required: counting them in a first pass. Standard input is spooled to a temporary file
+        if input_file=='-':
+          spool_h=tempfile.TemporaryFile()
+          tot_lines=0
+          for line in cmd_lines:
+            print >> spool_h, line
+            tot_lines+=1
+          spool_h.seek(0)
+          cmd_lines=read_command_lines(spool_h)
+        else:
+          tot_lines=sum(1 for line in read_command_lines(open(input_file)))
+        n_lines_per_job= float(  tot_lines ) / int(opt['n_jobs'])
+      if opt['n_lines']:  n_lines_per_job= opt['n_lines']
+
+    global name_e;  name_e=opt['n'] ;    global cmd_e; cmd_e=opt['c']
+
+    output_folder=opt['o']
+    #if single_job_mode:
+    #  if not output_folder: single_output_file= input_file+'.jb' #....
+    if not output_folder:    #raise Exception, "ERROR you must specify an expression for output files (option -o) ; please run -h for more information"
+      output_folder= input_file+'.jbs'
+
+    ######### names and commands including expressions
+    if (not opt['cost'] is None or opt['ch']) and array_mode:  raise notracebackException, 'ERROR options -cost and -ch are not available in job array mode. Use either  -nl number_of_lines   or   -nj number_of_jobs'
+    if opt['xp'] and opt['srun']: raise notracebackException, 'ERROR options -xp and -srun are not compatible'
+    if opt['ix'] and (opt['n_lines'] or opt['n_jobs']): raise notracebackException, 'ERROR option -ix is available only in array mode'
+    if opt['la'] and not array_mode: raise notracebackException, 'ERROR option -la is available only in array mode'
+    if opt['la'] and opt['sl']:      raise notracebackException, 'ERROR options -la and -sl are not compatible'
+    if opt['inc'] and array_mode: raise notracebackException, 'ERROR option -inc is not available in array mode. Use either  -nl number_of_lines   or   -nj number_of_jobs'
+    if opt['xp'] and array_mode: raise notracebackException, 'ERROR option -xp is not available in array mode. Use either  -nl number_of_lines   or   -nj number_of_jobs'
+    if not cmd_e is None and array_mode: raise notracebackException, 'ERROR -c cmdEXPR is not available in job array mode. Use either  -nl number_of_lines   or   -nj number_of_jobs  ; please run with -h for more information'
+    if not array_mode and cmd_e is None: cmd_e="x"  # standing for: execute full line
+    if not name_e is None:
+      if array_mode: raise notracebackException, 'ERROR -n nameEXPR is not available in job array mode. Use either  -nl number_of_lines   or   -nj number_of_jobs ; please run with -h for more information'
     else:
-      if input_file=='-': raise notracebackException, "ERROR you must specify job name with -N if reading from standard input!"
-      prefix_name=base_filename( input_file )
-    if not array_mode: name_e='"'+prefix_name+'."+n_job'
-  ### at this stage, if array_mode we have prefix_name ; if not array_mode we have name_e and cmd_e
-
-  if is_directory(output_folder):
-    if not opt['f']:
-      if not raw_input("Jobs folder "+output_folder+" existing from a previous run;  overwrite? will delete previous logs if present [Y] \n") in ['', 'Y', 'y', 'yes']:
-        raise notracebackException, "Aborted. "
-    bash('rm -r '+output_folder);
-  output_folder=Folder(output_folder);
+      if opt['N']:   prefix_name=opt['N'].rstrip('.')
+      else:
+        if input_file=='-': raise notracebackException, "ERROR you must specify job name with -N if reading from standard input!"
+        prefix_name=base_filename( input_file )
+      if not array_mode: name_e='"'+prefix_name+'."+n_job'
+    ### at this stage, if array_mode we have prefix_name ; if not array_mode we have name_e and cmd_e
+
+    if is_directory(output_folder) and not opt['resume'] and not opt['inc'] and not planning:
+      if not opt['f']:
+        if not raw_input("Jobs folder "+output_folder+" existing from a previous run;  overwrite? will delete previous logs if present [Y] \n") in ['', 'Y', 'y', 'yes']:
+          raise notracebackException, "Aborted. "
+      bash('rm -r '+output_folder);
+  if planning:   output_folder=output_folder.rstrip('/')+'/'   ## not created
+  else:          output_folder=Folder(output_folder);
   email= opt['email']
 
   ### determining header command, present in every job file
   init_command=''
   if opt['bin']:    init_command='export PATH='+opt['bin']+':$PATH\n'
-  if opt['H']:      init_command+= join([ line.strip() for line in open(opt['H']) ], '\n')  ##adding header lines
-  footer_command=''
-  if opt['F']:      footer_command+= join([ line.strip() for line in open(opt['F']) ], '\n')  ##adding footer lines
+  if opt['H']:      init_command+= 'set -a\n'+join([ line.strip() for line in open(opt['H']) ], '\n')+'\nset +a'  ##adding header lines; variables are exported, as commands run in child processes
+  footer_lines=''
+  if opt['F']:      footer_lines= join([ line.strip() for line in open(opt['F']) ], '\n')+'\n'  ##adding footer lines
+  footer_command=footer_lines+'exit $cj_status'    ## jobs end with the exit status of their commands, so that failures are seen by the scheduler (e.g. afterok dependencies)
 
   ## determining queue
   queue_name=opt['q']
@@ -310,118 +1073,399 @@ def main(args={}):
     ## cpus
     cpu_specs=slurm_pe_template.format(procs=opt['p']) if opt['p'] else ''
 
+  elif opt['sys']=='local':
+    queue_line=time_line=''
+    cpu_specs=local_pe_template.format(procs=opt['p']) if opt['p'] else ''
+
   mem=opt['m']
   add_options=opt['so']
   suffix_out='LOG'
   suffix_err='ERR' if not opt['joe'] else 'LOG'
+  submission_mode='each'
+  if opt['qsub'] and opt['sm'] in ['shell', 'pool'] and not opt['dag']:  submission_mode=opt['sm']   ## -dag needs the job IDs of each stage to submit the next
+  if opt['sys']=='local' and opt['qsub'] and not planning:
+    submitter=local_runner(procs_per_job=int(opt['p']), mem_per_job=float(opt['m']))
+  else:
+    submitter=job_submitter(opt['sys'], add_options, mode=submission_mode, ledger_file=output_folder+'submitted.ledger' if opt['qsub'] and not planning else None, 
+                            n_workers=int(opt['sp']), rate=float(opt['rate']), max_retries=int(opt['retry']))
+  writer=job_writer(submitter, n_threads=int(opt['wt']))
+  batch_h=None    ## with -sm array, spool of commands for the .batch array job, which runs single job files
+  if opt['qsub'] and opt['sm']=='array' and not array_mode:  batch_h=tempfile.TemporaryFile()
+
+  ## pre-rendering the constant part of headers
+  if   opt['sys']=='sge':
+    single_template, array_template = sge_header_single_job, sge_header_array_job
+    header_options=additional_options
+  elif opt['sys']=='slurm':
+    single_template, array_template = slurm_header_single_job, slurm_header_array_job
+    header_options=additional_options+('\n#SBATCH --open-mode=append'  if opt['sl'] else '')
+  elif opt['sys']=='local':
+    single_template, array_template = local_header_single_job, local_header_array_job
+    header_options=additional_options
+  constant_values=dict(email=email, additional_options=header_options, queue_line=queue_line, time_line=time_line, cpus=cpu_specs, mem=mem)
+  single_header=header_cache(single_template, ['name', 'logout', 'logerr'], **constant_values)
+  if max_running and opt['sys']=='sge':
+    constant_values['additional_options']+=sge_throttle_template.format(tc=max_running)
+  elif max_running and opt['sys']=='local':
+    constant_values['additional_options']+=local_throttle_template.format(tc=max_running)
+  hold_template=local_hold_template  if opt['sys']=='local'  else sge_hold_template    ## job dependencies by name, in headers
+  array_header= header_cache(array_template,  ['name', 'logout', 'logerr', 'range_str', 'dependency'], **constant_values)
+  range_suffix='%'+str(max_running)  if max_running and opt['sys']=='slurm'  else ''
+  init_text=init_command.rstrip('\n')+'\n'
+
+  ## list of job and array files written, and exit markers for single jobs
+  manifest_file=output_folder+'jobs_manifest'
+  plan=run_plan()
+  if planning:       manifest_h=open(os.devnull, 'w')
+  elif not opt['rf']:  manifest_h=open(manifest_file, 'w')
+  else:              manifest_h=open(manifest_file, 'a')
+  jobs_exit_file=abspath(output_folder+'jobs.exit')
+
+  ## incremental mode: hashes of job files content from the previous run
+  hashes_file=output_folder+'job_hashes'
+  previous_hashes={};  current_hashes={}
+  if opt['inc'] and is_file(hashes_file):
+    for line in open(hashes_file):
+      job_file, job_hash = line.rstrip('\n').split('\t')
+      previous_hashes[job_file]=job_hash
+
+  shard_levels=int(opt['shard'])
+  shard_dirs=set()   ## subdirectories already created with -shard
+  def job_path(name):
+    """ Returns the path of the job file with this name, in its subdirectory with -shard """
+    if not shard_levels:  return abspath(output_folder+name)
+    return abspath(shard_path(output_folder, name, shard_levels))
 
   def write_job(cmd, name, outfile, output_folder):
     """ Takes the command, plus all other variables computed and available in namespace, prepares a single job file and submit it if necessary"""
+    if shard_levels:
+      job_folder=os.path.dirname(outfile)
+      if not job_folder in shard_dirs:
+        if planning:                         plan.n_dirs+=1
+        elif not is_directory(job_folder):   os.makedirs(job_folder)
+        shard_dirs.add(job_folder)
     logout='{outfile}.{suf}'.format(outfile=outfile, suf=suffix_out)
     logerr='{outfile}.{suf}'.format(outfile=outfile, suf=suffix_err)
     if opt['sl']:
       logout='{outfolder}output_all_jobs.{suf}'.format(outfolder=output_folder, suf=suffix_out)
       logerr='{outfolder}output_all_jobs.{suf}'.format(outfolder=output_folder, suf=suffix_err)
 
-    write('Writing file: '+outfile)
-    if   opt['sys']=='sge':
-      header=sge_header_single_job.format(email=email, additional_options=additional_options, queue_line=queue_line, 
-                                          time_line=time_line, name=name, outfile=outfile, cpus=cpu_specs, mem=mem,
-                                          logout=logout, logerr=logerr)
-    elif opt['sys']=='slurm':
-      append_add='\n#SBATCH --open-mode=append'  if opt['sl'] else ''
-      if opt['srun']: cmd='\n'.join( map(lambda x:'srun '+x, [i.strip() for i in cmd.split('\n') if i.strip()] ) )
-      header=slurm_header_single_job.format(email=email, additional_options=additional_options + append_add , queue_line=queue_line, 
-                                            time_line=time_line, name=name, outfile=outfile, cpus=cpu_specs, mem=mem,
-                                            logout=logout, logerr=logerr)
+    n_lines=cmd.count('\n')
+    if opt['xp']:
+      cmd=parallel_exec_template.format(procs=opt['p'] if opt['p'] else '$(nproc)', outfile=outfile, lines=cmd, 
+                                        redirect_err='2>&1' if opt['joe'] else '2> '+outfile+'.$i.ERR')
+    elif opt['sys']=='slurm' and opt['srun']: cmd='\n'.join( map(lambda x:'srun '+x, [i.strip() for i in cmd.split('\n') if i.strip()] ) )
+    header=single_header.render(name, logout, logerr)
+    text=header +single_job_template.format(id=outfile, exit_file=jobs_exit_file)+single_job_body_template.format(init=init_text, cmd=cmd.rstrip('\n'), footer=footer_lines)
+    print >> manifest_h, 'job\t'+outfile+'\t'+name
+    if opt['inc']:
+      job_hash=md5(text).hexdigest()
+      current_hashes[outfile]=job_hash
+      if previous_hashes.get(outfile)==job_hash and is_file(outfile):   return
+      submitter.forget(outfile)   ## a changed job must be submitted again, even with -resume
 
-    write_to_file(header +init_command.rstrip('\n')+'\n'+cmd.rstrip('\n')+'\n'+footer_command, outfile)
-    if opt['qsub']:
+    if planning:
+      n_logs=(0 if opt['sl'] else 1 if logout==logerr else 2) + (n_lines*(1 if opt['joe'] else 2) if opt['xp'] else 0)
+      plan.add_job(n_lines, len(text)+1, n_logs, submitted=opt['qsub'] and not batch_h)
+      if batch_h:  print >> batch_h, batch_command(outfile, logout, logerr)
+      return
+    write('Writing file: '+outfile)
+    if batch_h:         print >> batch_h, batch_command(outfile, logout, logerr)
+    elif opt['qsub']:
       write(' \tsubmitting file!')
-      if   opt['sys']=='sge':    bbash('qsub   {} {} '.format(add_options,  outfile))
-      elif opt['sys']=='slurm':  bbash('sbatch {} {} '.format(add_options,  outfile)) 
+    writer.write(text, outfile, submit=opt['qsub'] and not batch_h)
     write('', 1)
 
-  def write_array_job(cmd_list, name, outfile, s,e, output_folder):
-    """ Takes the command list, plus all other variables computed and available in namespace, prepares an array file and submit it if necessary"""
-    write('Writing array file ('+str(len(cmd_list))+' jobs): '+outfile)
-    if   opt['sys']=='sge':
+  def batch_command(job_file, logout, logerr):
+    """ Returns the command to run a single job file inside a .batch array job, redirecting to its logs """
+    redirect='>>' if opt['sl'] else '>'
+    if logout==logerr:  return 'bash {f} {r} {o} 2>&1'.format(f=job_file, r=redirect, o=logout)
+    else:               return 'bash {f} {r} {o} 2{r} {e}'.format(f=job_file, r=redirect, o=logout, e=logerr)
+
+  def write_array_job(cmd_list, name, outfile, s,e, output_folder, batch=False, dependency='', submit_options=''):
+    """ Takes the command list (any iterable, consumed as a stream), plus all other variables computed and available in namespace, prepares an array file and submit it if necessary.
+    If e is None, the range ends with the last command. Without -ix, the commands are first streamed to a temporary file, since the header requires the range.
+    With -ix, they are streamed to the .cmds side file, and their offsets to the .idx side file. 
+    With batch=True, the commands run single job files which redirect their own logs (-sm array): -ix is implied, no srun is added and task logs are discarded.
+    dependency is added to the header as is (see write_array_chunks), submit_options to the submission command. Returns the job ID, if submitted and known """
+    task_var={'sge':'SGE_TASK_ID', 'slurm':'SLURM_ARRAY_TASK_ID', 'local':local_runner.task_var}[opt['sys']]
+    indexed=opt['ix'] or batch
+    add_srun=opt['sys']=='slurm' and opt['srun'] and not batch
+    n_cmds=0
+    if planning:
+      ## only sizes are computed: commands plus their index records (-ix) or #N# prefixes
+      n_bytes=0
+      for cmd in cmd_list:
+        n_cmds+=1
+        n_bytes+=len(cmd.rstrip('\n'))+1+ (len(str(n_cmds))+3  if not indexed  else index_record_width) + (5 if add_srun else 0)
+      if indexed:  exec_cmd=indexed_exec_template.format(index_file=outfile+'.idx', cmds_file=outfile+'.cmds', width=index_record_width, task_var=task_var)
+      else:        exec_cmd=awk_exec_template.format(outfile=outfile, task_var=task_var)
+    elif indexed:
+      cmds_file=outfile+'.cmds';   index_file=outfile+'.idx'
+      cmds_h=open(cmds_file, 'w'); index_h=open(index_file, 'w')
+      offset=0
+      for cmd in cmd_list:
+        n_cmds+=1
+        if add_srun:  cmd='srun '+cmd.strip()
+        cmd=cmd.rstrip('\n')+'\n'
+        index_h.write( '{:012d}\n'.format(offset) )
+        cmds_h.write(cmd)
+        offset+=len(cmd)
+      cmds_h.close(); index_h.close()
+      exec_cmd=indexed_exec_template.format(index_file=index_file, cmds_file=cmds_file, width=index_record_width, task_var=task_var)
+    else:
+      body_file=outfile+'.body'
+      body_h=open(body_file, 'w')
+      for cmd in cmd_list:
+        n_cmds+=1
+        if add_srun:  cmd='srun '+cmd.strip()
+        print >> body_h, '#'+str(n_cmds)+'# '+cmd.rstrip('\n')
+      body_h.close()
+      exec_cmd=awk_exec_template.format(outfile=outfile, task_var=task_var)
+    capture_logs=opt['la'] and not batch
+    if capture_logs:   exec_cmd=log_capture_start_line.format()+exec_cmd+log_capture_end_template.format(err_target='&1' if opt['joe'] else '$cj_log_dir/err')
+    exec_cmd=record_start_template.format()+exec_cmd+record_end_template.format(id='$'+task_var, exit_file=outfile+'.exit')
+    if capture_logs:   exec_cmd+=log_archive_template.format(archive=outfile+'.logs', task_var=task_var)
+    if e is None: e=n_cmds
+    if array_limits.get('max_tasks') and e-s+1>array_limits['max_tasks'] or array_limits.get('max_index') and e>array_limits['max_index']:
+      raise notracebackException, 'ERROR array {} has more tasks than the scheduler allows ({}). Use option -max to split it'.format(outfile, array_limits['max_tasks'] or array_limits['max_index'])
+    if not planning:  write('Writing array file ('+str(n_cmds)+' jobs): '+outfile)
+    if   opt['sys'] in ['sge', 'local']:
       logout='{outfile}.$TASK_ID.{suf}'.format(outfile=outfile, suf=suffix_out)
       logerr='{outfile}.$TASK_ID.{suf}'.format(outfile=outfile, suf=suffix_err)
-      if opt['sl']: 
-        logout='{outfile}.{suf}'.format(outfile=outfile, suf=suffix_out)
-        logerr='{outfile}.{suf}'.format(outfile=outfile, suf=suffix_err)
-
-      header=sge_header_array_job.format(email=email, additional_options=additional_options, queue_line=queue_line, 
-                                          time_line=time_line, name=name, outfile=outfile, cpus=cpu_specs, mem=mem,
-                                          logout=logout, logerr=logerr,
-                                          range_str='{}-{}'.format(s,e))
-      exec_cmd="""awk -v task_id=$SGE_TASK_ID -F"#" 'BEGIN{pat="^#" task_id "# "}$0 ~ pat{system(substr($0, length($2)+4))}' """+outfile+'\n'
     elif opt['sys']=='slurm':
       logout='{outfile}.%a.LOG'.format(outfile=outfile)
       logerr='{outfile}.%a.ERR'.format(outfile=outfile)
-      if opt['sl']: 
-        logout='{outfile}.{suf}'.format(outfile=outfile, suf=suffix_out)
-        logerr='{outfile}.{suf}'.format(outfile=outfile, suf=suffix_err)
-      append_add='\n#SBATCH --open-mode=append'  if opt['sl'] else ''        
-
-      header=slurm_header_array_job.format(email=email, additional_options=additional_options+append_add, queue_line=queue_line, 
-                                            time_line=time_line, name=name, outfile=outfile, cpus=cpu_specs, mem=mem,
-                                           logout=logout, logerr=logerr,
-                                            range_str='{}-{}'.format(s,e)) 
-      exec_cmd="""awk -v task_id=$SLURM_ARRAY_TASK_ID -F"#" 'BEGIN{pat="^#" task_id "# "}$0 ~ pat{system(substr($0, length($2)+4))}' """+outfile+'\n'
-      if opt['srun']: cmd='\n'.join( map(lambda x:'srun '+x, [i.strip() for i in cmd.split('\n') if i.strip()] ) )
-
-    out_text=header+init_command.rstrip('\n')+'\n'+ exec_cmd + join([ '#'+str(index+1)+'# '+cmd.rstrip('\n') for index, cmd in enumerate(cmd_list)], '\n' )+     footer_command
-    write_to_file(out_text, outfile)
+    if opt['sl']: 
+      logout='{outfile}.{suf}'.format(outfile=outfile, suf=suffix_out)
+      logerr='{outfile}.{suf}'.format(outfile=outfile, suf=suffix_err)
+    if batch or capture_logs:     logout=logerr='/dev/null'
+    header=array_header.render(name, logout, logerr, '{}-{}{}'.format(s,e, range_suffix), dependency)
+    if planning:
+      n_logs=0 if batch or opt['sl'] else 3 if capture_logs else (e-s+1)*(1 if logout==logerr else 2)
+      plan.add_array(e-s+1, 3 if indexed else 1, len(header)+len(init_text)+len(exec_cmd)+n_bytes+len(footer_command)+1, n_logs, submitted=opt['qsub'])
+      return None
+    print >> manifest_h, '{t}\t{f}\t{s}-{e}'.format(t='batch' if batch else 'array', f=outfile, s=s, e=e)
+
+    out_h=open(outfile, 'w')
+    out_h.write(header+init_text+ exec_cmd)
+    if not indexed:
+      body_h=open(body_file)
+      shutil.copyfileobj(body_h, out_h)
+      body_h.close()
+      os.remove(body_file)
+    print >> out_h, footer_command
+    out_h.close()
     if opt['qsub']:
       write(' \tsubmitting file!')
-      if   opt['sys']=='sge':    bbash('qsub   {} {} '.format(add_options,  outfile))
-      elif opt['sys']=='slurm':  bbash('sbatch {} {} '.format(add_options,  outfile)) 
+      return submitter.submit(outfile, n_jobs=e-s+1, options=submit_options)
+
+  def write_array_chunks(cmd_list, name, outfile, s,e, output_folder, batch=False, dependency='', submit_options=''):
+    """ Like write_array_job, but with -max the commands are split into consecutive arrays of at most that many tasks: NAME.1, NAME.2 ...
+    The range s-e refers to all commands, and it is mapped to each array; arrays entirely out of range are not written. 
+    With -chain, each array waits for the previous one written to finish. Returns the list of [job_name, array_file, job_id] of arrays written """
+    if not max_tasks:   return [ [name, outfile, write_array_job(cmd_list, name, outfile, s,e, output_folder, batch=batch, dependency=dependency, submit_options=submit_options)] ]
+    arrays=[];  previous_name=None
+    base_dependency=dependency
+    for n_chunk, chunk in enumerate(iter_chunks(cmd_list, max_tasks), 1):
+      offset=(n_chunk-1)*max_tasks
+      if not e is None and e<=offset:  break
+      chunk_s=max(s-offset, 1)
+      chunk_e=e-offset  if not e is None and e-offset<max_tasks  else None
+      if chunk_s>max_tasks:    ## out of range: the commands are consumed to reach the next chunk
+        for cmd in chunk: pass
+        continue
+      chunk_name=name+'.'+str(n_chunk)
+      dependency=base_dependency
+      if opt['chain'] and opt['sys']=='slurm':      chunk_name=name;  dependency=slurm_singleton_line
+      elif opt['chain'] and previous_name:           dependency=hold_template.format(names=previous_name)
+      if previous_name and not planning:  write('', 1)
+      job_id=write_array_job(chunk, chunk_name, outfile+'.'+str(n_chunk), chunk_s, chunk_e, output_folder, batch=batch, dependency=dependency, submit_options=submit_options)
+      arrays.append([chunk_name, outfile+'.'+str(n_chunk), job_id])
+      previous_name=chunk_name
+    return arrays
+
+  def write_dag(cmd_lines):
+    """ -dag: writes the arrays of each stage in input, in order. Each stage depends on the arrays of the stages listed in its declaration: 
+    in sge, through -hold_jid with their job names in the header; in slurm, through --dependency=afterok with their job IDs, added when submitting.
+    Script submit_dag.sh is also written in the jobs folder, to submit all arrays in order """
+    stage_arrays={}  # stage name -> list of [job_name, array_file, job_id]
+    script_vars={}   # array file -> shell variable with its job ID, in submit_dag.sh
+    script_h=open(output_folder+'submit_dag.sh' if not planning else os.devnull, 'w')
+    print >> script_h, '#!/bin/bash\nset -e'
+    for stage, after, commands in read_stages(cmd_lines):
+      if stage in stage_arrays:   raise notracebackException, 'ERROR stage {} is declared more than once'.format(stage)
+      for upstream_stage in after:
+        if not upstream_stage in stage_arrays:  raise notracebackException, 'ERROR stage {} depends on {}, which is not declared before it'.format(stage, upstream_stage)
+      first_command=list(islice(commands, 1))
+      if not first_command:  raise notracebackException, 'ERROR stage {} has no command lines'.format(stage)
+      upstream=[ array  for upstream_stage in after  for array in stage_arrays[upstream_stage] ]
+      dependency='';  submit_options=''
+      if upstream and opt['sys'] in ['sge', 'local']:
+        dependency=hold_template.format(names=join([job_name for job_name, array_file, job_id in upstream], ','))
+      elif upstream and opt['sys']=='slurm' and opt['qsub'] and not planning:    ## nothing is submitted with -plan, so there are no job IDs
+        if not all(job_id for job_name, array_file, job_id in upstream):  raise notracebackException, 'ERROR could not read the job IDs of stage(s) '+join(after, ',')
+        submit_options='--dependency=afterok:'+join([job_id for job_name, array_file, job_id in upstream], ':')
+      name=prefix_name+'.'+stage
+      stage_arrays[stage]=write_array_chunks(chain(first_command, commands), name, abspath(output_folder+name), 1, None, output_folder, dependency=dependency, submit_options=submit_options)
+      write('', 1)
+      for job_name, array_file, job_id in stage_arrays[stage]:
+        if   opt['sys']=='sge':     print >> script_h, 'qsub {} {}'.format(opt['so'], array_file)
+        elif opt['sys']=='slurm':
+          script_vars[array_file]='cj_job{}'.format(len(script_vars)+1)
+          script_dependency='--dependency=afterok:'+join([ '$'+script_vars[upstream_file] for job_name, upstream_file, job_id in upstream], ':')  if upstream  else ''
+          print >> script_h, '{v}=$(sbatch --parsable {so} {d} {f}); {v}=${{{v}%%;*}}'.format(v=script_vars[array_file], so=opt['so'], d=script_dependency, f=array_file)
+    if opt['sys']=='local':  print >> script_h, '{} -sys local -p {} -m {} -rl {}'.format(abspath(sys.argv[0]), opt['p'], opt['m'], abspath(output_folder))
+    script_h.close()
+    if not opt['qsub'] and not planning:  write('Written {n} stages; to submit them in order, run: bash {f}'.format(n=len(stage_arrays), f=output_folder+'submit_dag.sh'), 1)
+
+  def packed_groups(cmd_lines):
+    """ Returns the lists of (index, line) to be included in each job, balancing their total estimated cost according to -cost or -ch """
+    if not opt['cost'] is None:
+      try:       cost_code=compile(opt['cost'], '<costEXPR>', 'eval')
+      except SyntaxError:   raise notracebackException, "ERROR can't compile cost expression: "+opt['cost']
+      costs=[]
+      for index, cline in enumerate(cmd_lines, 1):
+        x=tab_line(cline);  index=str(index)
+        try:       costs.append( float(eval(cost_code)) )
+        except:
+          printerr("Can't evaluate cost expression: "+opt['cost'], 1)
+          raise
+    else:
+      history=load_cost_history(opt['ch'])
+      known=[ history[cline] for cline in cmd_lines if cline in history ]
+      default_cost=sum(known)/len(known) if known else 1.0
+      costs=[ history.get(cline, default_cost) for cline in cmd_lines ]
+      write('Cost history: {} of {} lines found in {}'.format(len(known), len(cmd_lines), opt['ch']), 1)
+    n_bins=int(round( len(cmd_lines)/n_lines_per_job )) if opt['n_jobs'] else (len(cmd_lines)-1)/n_lines_per_job+1
+    bins=pack_lines(costs, n_bins)
+    count_based_max=max( sum(costs[index-1] for index, cline in group) for group in count_groups(cmd_lines, n_lines_per_job) )
+    write('Packed {l} lines into {j} jobs; max estimated job cost: {p:.1f} (split by count: {c:.1f})'.format(l=len(cmd_lines), j=len(bins), 
+                                    p=max( sum(costs[i] for i in items) for items in bins ), c=count_based_max), 1)
+    return [ [ (i+1, cmd_lines[i]) for i in items ] for items in bins ]
+
+  def resubmit_failed():
+    """ Scans the jobs folder (-rf) using the manifest and exit markers; writes (and submits) arrays with the failed commands only """
+    manifest=[ line.rstrip('\n').split('\t') for line in open(manifest_file) ]
+    n_failed_tot=0
+    for entry in manifest:
+      if entry[0]!='array': continue
+      array_file=entry[1];  s,e = map(int, entry[2].split('-'))
+      ## task exit status: tasks are ok if their last record has exit status 0. A byte per task is kept
+      task_ok=bytearray(e+1)
+      if is_file(array_file+'.exit'):
+        for line in open(array_file+'.exit'):
+          fields=line.split()
+          task_ok[int(fields[0])]= fields[1]=='0'
+      n_failed=sum( 1 for task in xrange(s, e+1) if not task_ok[task] )
+      if not n_failed: continue
+      n_failed_tot+=n_failed
+      def failed_commands():
+        if is_file(array_file+'.cmds'):     tasks_cmds=enumerate(open(array_file+'.cmds'), 1)
+        else:                               tasks_cmds=( (int(line.split('#')[1]), line[len(line.split('#')[1])+3:]) for line in open(array_file) if line.startswith('#') and line.split('#')[1].isdigit() )
+        for task, cmd in tasks_cmds:
+          if s<=task<=e and not task_ok[task]:
+            if opt['sys']=='slurm' and opt['srun'] and cmd.startswith('srun '): cmd=cmd[5:]   ## srun is added again by write_array_job
+            yield cmd
+      retry_file=array_file+'.retry'
+      submitter.forget(retry_file)
+      write('Failed tasks in {}: {}'.format(array_file, n_failed), 1)
+      write_array_chunks(failed_commands(), base_filename(retry_file), retry_file, 1, None, output_folder)
+      write('', 1)
+      entry[0]='retried'
+
+    ## single job files: failed if the last record in jobs.exit is not 0, or missing
+    job_ok={}
+    if is_file(jobs_exit_file):
+      for line in open(jobs_exit_file):
+        fields=line.split()
+        job_ok[fields[0]]= fields[1]=='0'
+    failed_jobs=[ entry[1] for entry in manifest if entry[0]=='job' and not job_ok.get(entry[1]) ]
+    if failed_jobs:
+      n_failed_tot+=len(failed_jobs)
+      batch_file=abspath(output_folder+'failed_jobs.batch')
+      submitter.forget(batch_file)
+      write('Failed job files: {}'.format(len(failed_jobs)), 1)
+      write_array_chunks( (batch_command(job_file, *job_file_logs(job_file)) for job_file in failed_jobs), 'failed_jobs', batch_file, 1, None, output_folder, batch=True)
+      write('', 1)
+
+    ## the manifest is rewritten to mark arrays which were retried, and to add the new arrays
+    manifest_h.close()
+    new_entries=[ line.rstrip('\n').split('\t') for line in open(manifest_file) ][len(manifest):]
+    manifest_h2=open(manifest_file+'.tmp', 'w')
+    for entry in manifest+new_entries:  print >> manifest_h2, join(entry, '\t')
+    manifest_h2.close()
+    os.rename(manifest_file+'.tmp', manifest_file)
+    if not n_failed_tot:  write('No failed jobs found in '+output_folder, 1)
 
   #####################
-  if array_mode:
+  if opt['rf']:
+    resubmit_failed()
+  elif opt['dag']:
+    write_dag(cmd_lines)
+  elif array_mode:
     name=prefix_name
     outfile=abspath(output_folder+name)
     if opt['r']:       s,e=map(int, opt['r'].split('-'))
-    else:              s,e=1,len(cmd_lines)
-    write_array_job(cmd_lines, name, outfile, s,e, output_folder)
+    else:              s,e=1,None
+    write_array_chunks(cmd_lines, name, outfile, s,e, output_folder)
   else:
   ## from here it goes only if we're not in array job mode
   #cycling file ;   producing a "cmd" variable with all the lines to put in a job; then we write (and submit it)
-    cmd='';     lines_up_to_now=0;     index=1;     n_job=1
-    for cline in cmd_lines:
-      x=tab_line(cline.strip())
-      index=str(index);       n_job=str(n_job) # converting to str just to allow to use them inside the custom expressions
+    ## expressions are compiled once, then evaluated for every line
+    try:       name_code=compile(name_e, '<nameEXPR>', 'eval')
+    except SyntaxError:   raise notracebackException, "ERROR can't compile name expression: "+name_e
+    try:       cmd_code= compile(cmd_e,  '<jobEXPR>',  'eval')
+    except SyntaxError:   raise notracebackException, "ERROR can't compile command expression: "+cmd_e
+    if not opt['cost'] is None or opt['ch']:    job_groups=packed_groups(cmd_lines)
+    else:                                         job_groups=count_groups(cmd_lines, n_lines_per_job)
 
-      try:       name=  eval(  name_e )
-      except:
-        printerr("Can't evaluate name expression: "+name_e, 1)
-        raise
+    for n_job, group in enumerate(job_groups, 1):
+      cmd=''
+      n_job=str(n_job)    # converting to str just to allow to use them inside the custom expressions
+      for index, cline in group:
+        x=tab_line(cline.strip())
+        index=str(index)
 
-      outfile=abspath(output_folder+name)
+        try:       name=  eval(  name_code )
+        except:
+          printerr("Can't evaluate name expression: "+name_e, 1)
+          raise
 
-      try:       cmd+=  eval(  cmd_e )+'\n'
-      except:
-        printerr("Can't evaluate command expression: "+cmd_e, 1)
-        raise
+        outfile=job_path(name)
 
-      lines_up_to_now+=1
-      n_job=int(n_job)
+        try:
+          if opt['xp']:   cmd+=  index+' '+eval(  cmd_code ).replace('\n', ' ; ')+'\n'   ## parallel executor: one line per command, prefixed by its index
+          else:           cmd+=  eval(  cmd_code )+'\n'
+        except:
+          printerr("Can't evaluate command expression: "+cmd_e, 1)
+          raise
 
-      if lines_up_to_now >= n_lines_per_job*n_job: # enough lines. lets' write to a file (and submit)
+      if cmd.strip():   # enough lines. lets' write to a file (and submit)
         write_job(cmd, name, outfile, output_folder)
-        cmd=''
-        n_job+=1
-
-      index=int(index)
-      index+=1
 
-    #remaining lines
-    if cmd.strip().split():
-      write_job(cmd, name, outfile, output_folder)
+    writer.close()
+    if opt['inc'] and not planning:
+      n_unchanged=len([job_file for job_file in current_hashes if previous_hashes.get(job_file)==current_hashes[job_file]])
+      write('Incremental mode: {u} job files unchanged, {w} written'.format(u=n_unchanged, w=len(current_hashes)-n_unchanged), 1)
+      hashes_h=open(hashes_file+'.tmp', 'w')
+      for job_file in current_hashes:  print >> hashes_h, job_file+'\t'+current_hashes[job_file]
+      hashes_h.close()
+      os.rename(hashes_file+'.tmp', hashes_file)
+    if batch_h and batch_h.tell():   ## -sm array: a single array job runs all job files written
+      batch_h.seek(0)
+      if   opt['N']:        batch_name=opt['N'].rstrip('.')
+      elif input_file!='-': batch_name=base_filename( input_file )
+      else:                 batch_name='cluster_job'
+      batch_file=abspath(output_folder+batch_name+'.batch')
+      if opt['inc']:  submitter.forget(batch_file)   ## in incremental mode, the .batch array contains only the job files just written
+      write_array_chunks(read_command_lines(batch_h), batch_name, batch_file, 1, None, output_folder, batch=True)
+      batch_h.close()
 
+  if not manifest_h.closed:  manifest_h.close()
   write('', 1)
+  submitter.close()
+  if planning:  plan.report(submission_mode, int(opt['sp']), float(opt['rate']))
 
 class notracebackException(Exception):
   """ When these exceptions are raised, the traceback is not printed, just a short message """
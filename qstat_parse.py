@@ -1,7 +1,19 @@
 #! /usr/bin/env python2.7
 from string import *
 import sys
+import time
+import os
+import fcntl
+import cPickle
+import tempfile
+import getpass
+import pipes
+from hashlib import md5
+from collections import deque
+from operator import attrgetter
 from commands import *
+try:               import xml.etree.cElementTree as ElementTree
+except ImportError: import xml.etree.ElementTree as ElementTree
 from MMlib import *
 ### allowing this to be piped without weird python complains
 import signal
@@ -11,9 +23,9 @@ def_opt= {'temp':'/users-d3/mmariotti/temp',
           'i':0, 'o':0, 'v':0,
           'f':            '{id:9} {state:3} {slots:3} {tasks:6} {queue:12} {node:18} {name}',
           'fa':'{owner:12} {id:9} {state:3} {slots:3} {tasks:6} {queue:12} {node:18} {name}',          
-          'q':0, 'a':0, 'x':''}
+          'q':0, 'a':0, 'x':'', 'g':0, 'w':0, 'wn':0, 'wr':0, 'sys':'sge', 'acct':0, 'c':0, 'cf':''}
 
-help_msg="""qstat_parse.py: Utility to visualize the output of qstat -xml in a convenient way. 
+help_msg="""qstat_parse.py: Utility to visualize the output of qstat -xml (SGE) or squeue (Slurm) in a convenient way. 
 For a fresh qstat run, run this program without input.
 To read text from an input, use: 
  -i inputfile    (use "-i -" for standard input) 
@@ -25,7 +37,30 @@ To read text from an input, use:
 
 -x  if qstat is run (no -i provided), use this to provide any qstat options
 -a  add option ' -u "*" ' to qstat, to display jobs for all users. If -f is not provided, owner is also displayed
--q  display queue usage instead; simply wraps 'qstat -g c'
+-q  display queue usage instead; simply wraps 'qstat -g c'  (sinfo -s with -sys slurm)
+
+-sys   scheduler: sge (default) or slurm. With slurm, squeue is run instead of qstat, and its jobs are shown with the same attributes:
+       queue is the partition, slots the number of CPUs, tasks the array task id or range. -x passes options to squeue. 
+       With -i, the input must be in the format of:  squeue -h -o '%F|%K|%t|%C|%P|%N|%u|%Q|%j'
+-acct  with -sys slurm, read the accounting records of sacct instead, to include finished jobs (e.g. -x "-S 2024-01-01" ). 
+       With -i, the input must be in the format of:  sacct -n -P -X -o JobID,State,AllocCPUS,Partition,NodeList,User,JobName
+
+-c   snapshot cache: reuse the jobs read by a qstat/squeue/sacct query for this many seconds, so that concurrent or repeated runs
+     of the same query run it only once. The jobs are stored in a binary file, refreshed by a single process when expired.
+     Not used with -i
+-cf  cache file (default: a file named after the query, in folder qstat_parse_cache.UID in the temporary folder, private to each user).
+     Cache files not owned by the current user are ignored
+
+-g  summary instead of one line per job: comma separated attributes to group by, among those listed for -f (e.g. -g owner,state )
+    For each group, the number of jobs, array tasks (counting the ranges of pending arrays) and slots is printed. 
+    Grouping by id collapses the array tasks of each job:  -g id,state
+
+-w  watch mode: run qstat or squeue (or read again the -i file) every this many seconds, and print only the changes of state of jobs and 
+    array tasks since the previous poll, e.g.  qw -> r ,  r -> gone . Error states are highlighted
+-wn stop watching after this number of polls (default: no limit)
+-wr jobs folder of a cluster_job.py run submitted with -Q: at each poll, also print how many of the tasks it submitted are done 
+    (no longer in the queue), with the completion rate over the last polls and an estimate of the remaining time. 
+    Watching stops when they are all done
 """
 
 command_line_synonyms={}
@@ -35,7 +70,229 @@ command_line_synonyms={}
 ###### start main program function
 
 class job (object):
-  """ """
+  """ Compact record of a job (or array task) in the scheduler. Fields are strings; those missing in the scheduler output are empty """
+  __slots__=['id', 'state', 'slots', 'tasks', 'queue', 'node', 'name', 'owner', 'priority']
+  def __init__(self, id='', state='', slots='', tasks='', queue='', node='', name='', owner='', priority=''):
+    self.id=id; self.state=state; self.slots=slots; self.tasks=tasks; self.queue=queue; self.node=node
+    self.name=name; self.owner=owner; self.priority=priority
+  def as_dict(self):
+    """ Returns the fields as a dictionary, to be used with the output format:  output_format.format(**j.as_dict()) """
+    return {'id':self.id, 'state':self.state, 'slots':self.slots, 'tasks':self.tasks, 'queue':self.queue, 'node':self.node,
+            'name':self.name, 'owner':self.owner, 'priority':self.priority}
+
+## elements of each job_list in qstat -xml, mapped to job record fields
+qstat_xml_fields={'JB_job_number':'id', 'JAT_prio':'priority', 'JB_name':'name', 'JB_owner':'owner', 'state':'state', 'tasks':'tasks', 'slots':'slots'}
+
+## elements holding the job_list elements in qstat -xml (also with -f)
+qstat_xml_sections=set(['job_info', 'queue_info', 'Queue-List'])
+
+def job_from_element(element):
+  """ Builds a job record from a complete job_list element """
+  fields={}
+  for child in element:
+    text=child.text
+    if not text: continue
+    if text.__class__ is unicode: text=text.encode('utf-8')   # the parser returns str for ascii text
+    tag=child.tag
+    if   tag in qstat_xml_fields:  fields[qstat_xml_fields[tag]]=text.strip()
+    elif tag=='queue_name':        fields['queue'], _, fields['node'] = text.strip().partition('@')
+  return job(**fields)
+
+def parse_qstat_xml(input_file_h):
+  """ Generator of job records from the output of qstat -xml, read as a stream. 
+  Only start events are requested to the parser: a job_list is complete when the next one (or a new section) starts, and it is then 
+  converted and removed from the tree, so memory does not depend on the number of jobs """
+  section=None; pending=None; pending_section=None
+  try:
+    for _, element in ElementTree.iterparse(input_file_h, events=('start',)):
+      tag=element.tag
+      if tag!='job_list' and tag not in qstat_xml_sections: continue
+      if pending is not None:
+        yield job_from_element(pending)
+        pending.clear()
+        if pending_section is not None:  pending_section.remove(pending)
+        pending=None
+      if tag=='job_list':  pending=element; pending_section=section
+      else:                section=element
+    if pending is not None:  yield job_from_element(pending)
+  except SyntaxError, e:
+    raise Exception, "ERROR the qstat output is not valid XML: "+str(e)
+
+def task_count(tasks):
+  """ Number of tasks in the tasks field of a job record: empty for single jobs, a task id for running array tasks, 
+  or ranges like 1-100:1,120 for pending ones """
+  if not tasks: return 1
+  n=0
+  for r in tasks.split(','):
+    if '-' in r:
+      r, _, step = r.partition(':')
+      start, end = r.split('-')
+      n+=(int(end)-int(start))//int(step or 1)+1
+    else: n+=1
+  return n
+
+def aggregate_jobs(jobs, keys):
+  """ Groups job records in a single pass by the values of the attributes in keys.
+  Returns a dictionary: tuple of values -> [set of job ids, number of tasks, number of slots] """
+  groups={}
+  group_of=attrgetter(*keys)
+  n_tasks_of={}    # tasks field -> number of tasks; few distinct values are found in practice
+  for j in jobs:
+    group=group_of(j)
+    if group in groups:  g=groups[group]
+    else:                g=groups[group]=[set(), 0, 0]
+    tasks=j.tasks
+    if tasks in n_tasks_of: n_tasks=n_tasks_of[tasks]
+    else:                   n_tasks=n_tasks_of[tasks]=task_count(tasks)
+    g[0].add(j.id);   g[1]+=n_tasks;   g[2]+=n_tasks*int(j.slots or 1)
+  if len(keys)==1:  groups=dict( ((group,), g) for group, g in groups.iteritems() )
+  return groups
+
+## squeue output format read by parse_squeue: array job id, array task id (or range), state, CPUs, partition, nodes, user, priority, name
+squeue_format='%F|%K|%t|%C|%P|%N|%u|%Q|%j'
+## sacct fields read by parse_sacct; jobs steps are not listed (-X)
+sacct_fields='JobID,State,AllocCPUS,Partition,NodeList,User,JobName'
+
+def slurm_array_tasks(tasks):
+  """ Converts an array task field of Slurm (5, [1-10%2], N/A) to the format of the tasks attribute (5, 1-10, empty) """
+  if tasks in ('N/A', ''): return ''
+  return tasks.strip('[]').split('%')[0]
+
+def parse_squeue(input_file_h):
+  """ Generator of job records from the output of squeue -h -o squeue_format, read one line at the time """
+  for line in input_file_h:
+    line=line.rstrip('\n')
+    if not line: continue
+    fields=line.split('|', 8)   ## the job name is last, and may contain |
+    if len(fields)!=9: raise Exception, "ERROR the squeue output is not in the expected format ("+squeue_format+"): "+line
+    array_id, tasks, state, cpus, partition, nodes, user, priority, name = fields
+    yield job(id=array_id, state=state, slots=cpus, tasks=slurm_array_tasks(tasks), queue=partition, node=nodes, name=name, owner=user, priority=priority)
+
+def parse_sacct(input_file_h):
+  """ Generator of job records from the output of sacct -n -P -X -o sacct_fields, read one line at the time. 
+  Job ids of array tasks (123_5, 123_[1-10]) are split into id and tasks; states like "CANCELLED by 123" are reduced to their first word """
+  for line in input_file_h:
+    line=line.rstrip('\n')
+    if not line: continue
+    fields=line.split('|', 6)
+    if len(fields)!=7: raise Exception, "ERROR the sacct output is not in the expected format ("+sacct_fields+"): "+line
+    job_id, state, cpus, partition, nodes, user, name = fields
+    job_id, _, tasks = job_id.partition('_')
+    if nodes=='None assigned': nodes=''
+    yield job(id=job_id, state=state.split(' ')[0], slots=cpus, tasks=slurm_array_tasks(tasks), queue=partition, node=nodes, name=name, owner=user)
+
+## job states reported as errors by Slurm (squeue compact codes and sacct names); in SGE, error states contain E (e.g. Eqw)
+slurm_error_states=set(['F', 'NF', 'OOM', 'TO', 'BF', 'DL', 'FAILED', 'NODE_FAIL', 'OUT_OF_MEMORY', 'TIMEOUT', 'BOOT_FAIL', 'DEADLINE'])
+
+def is_error_state(state, sys_name='sge'):
+  """ Returns True if state is an error state of the scheduler sys_name """
+  if sys_name=='slurm': return state in slurm_error_states
+  return 'E' in state
+
+class snapshot_cache(object):
+  """ Jobs read by a scheduler query, stored in cache_file as a cPickle list of tuples of job fields, and reused for ttl seconds.
+  When the file is expired, one process refreshes it while holding a lock on cache_file.lock; the others wait for it and read the new file.
+  The file is replaced atomically, so reading does not need the lock """
+  def __init__(self, cache_file, ttl):
+    self.cache_file=cache_file
+    self.ttl=ttl
+  def load(self):
+    """ Returns the list of cached job records, or None if the file is missing, expired, or not owned by the current user 
+    (unpickling a file written by someone else could run arbitrary code) """
+    try:
+      cache_h=open(self.cache_file, 'rb')
+      stat=os.fstat(cache_h.fileno())
+    except (OSError, IOError):  return None
+    if stat.st_uid!=os.getuid() or time.time()-stat.st_mtime>self.ttl:
+      cache_h.close()
+      return None
+    try:      return [ job(*fields) for fields in cPickle.load(cache_h) ]
+    except (EOFError, cPickle.UnpicklingError):  return None
+    finally:  cache_h.close()
+  def jobs(self, read_jobs):
+    """ Returns the list of job records from the cache if not expired; otherwise from the iterable returned by read_jobs(), which are then cached """
+    jobs=self.load()
+    if jobs is not None: return jobs
+    try:
+      lock_h=open(self.cache_file+'.lock', 'a')
+      try:              os.chmod(self.cache_file+'.lock', 0666)      ## lockable by other users
+      except OSError:   pass
+    except IOError:   lock_h=open(self.cache_file+'.lock', 'r')    ## created by another user; flock works also on files open for reading
+    try:
+      fcntl.flock(lock_h, fcntl.LOCK_EX)
+      jobs=self.load()     ## refreshed by another process while waiting for the lock
+      if jobs is not None: return jobs
+      jobs=list(read_jobs())
+      fields_of=attrgetter(*job.__slots__)
+      temp_file=self.cache_file+'.'+str(os.getpid())
+      temp_h=open(temp_file, 'wb')
+      ## equal values are stored once: cPickle writes references to objects already written
+      values={}
+      cPickle.dump([ tuple(values.setdefault(v, v) for v in fields_of(j)) for j in jobs ], temp_h, cPickle.HIGHEST_PROTOCOL)
+      temp_h.close()
+      os.chmod(temp_file, 0644)
+      try:    os.rename(temp_file, self.cache_file)
+      except OSError:  os.remove(temp_file)   ## e.g. file of another user in a sticky folder; jobs are used without caching
+      return jobs
+    finally:
+      fcntl.flock(lock_h, fcntl.LOCK_UN)
+      lock_h.close()
+
+def job_snapshot(jobs):
+  """ Returns a dictionary (id, tasks) -> job record, to compare successive polls. Pending arrays are keyed by (id, ''),  
+  so that tasks leaving their range do not count as changes """
+  snapshot={}
+  for j in jobs:
+    if task_count(j.tasks)>1:   snapshot[(j.id, '')]=j
+    else:                       snapshot[(j.id, j.tasks)]=j
+  return snapshot
+
+def state_changes(previous, current):
+  """ Generator of [job record, old state, new state] between two snapshots. Old state is '' for new jobs, new state is 'gone' for 
+  those not in the queue anymore. Array tasks which were in a pending range take the state of the range as old state, and are 
+  reported only if it changed. A pending range is not reported as gone while its job still has tasks in the queue """
+  for key, j in current.iteritems():
+    if key in previous:  old_state=previous[key].state
+    else:
+      pending_range=previous.get( (key[0], '') )
+      old_state=pending_range.state if pending_range else ''
+    if old_state!=j.state:  yield [j, old_state, j.state]
+  current_ids=set( key[0] for key in current )
+  for key, j in previous.iteritems():
+    if key in current or (key[1]=='' and key[0] in current_ids):  continue
+    yield [j, j.state, 'gone']
+
+class run_progress(object):
+  """ Completion of the tasks submitted by a cluster_job.py run, read from the submitted.ledger and jobs_manifest files of its jobs folder.
+  Tasks are done when they are not in the queue anymore, regardless of their exit status (see cluster_job.py -st) """
+  def __init__(self, jobs_folder, n_polls=10):
+    self.folder=Folder(jobs_folder)
+    if not is_file(self.folder+'submitted.ledger'): raise Exception, "ERROR submitted.ledger not found in "+self.folder+"  ; was the run submitted with -Q?"
+    self.history=deque(maxlen=n_polls)   # [time, n_done]
+  def submitted_tasks(self):
+    """ Returns a dictionary job_id -> number of tasks. The ledger is read at each poll, since the run may still be submitting """
+    n_tasks={}
+    if is_file(self.folder+'jobs_manifest'):
+      for line in open(self.folder+'jobs_manifest'):
+        entry=line.rstrip('\n').split('\t')
+        if entry[0]!='job':   s,e = map(int, entry[2].split('-'));   n_tasks[entry[1]]=e-s+1
+    submitted={}
+    for line in open(self.folder+'submitted.ledger'):
+      job_file, job_id=line.rstrip('\n').split('\t')
+      submitted[job_id]=n_tasks.get(job_file, 1)
+    return submitted
+  def update(self, snapshot):
+    """ Returns [n_done, n_submitted, rate (tasks per second, or None), eta (seconds, or None)] """
+    submitted=self.submitted_tasks()
+    n_submitted=sum(submitted.values())
+    n_queued=sum( task_count(j.tasks) for j in snapshot.itervalues() if j.id in submitted )
+    n_done=n_submitted-n_queued
+    self.history.append( [time.time(), n_done] )
+    rate=eta=None
+    if len(self.history)>1 and self.history[-1][0]>self.history[0][0]:
+      rate=float(self.history[-1][1]-self.history[0][1])/(self.history[-1][0]-self.history[0][0])
+      if rate>0: eta=n_queued/rate
+    return [n_done, n_submitted, rate, eta]
 
 def main(args={}):
 #########################################################
@@ -48,53 +305,102 @@ def main(args={}):
   #global split_folder;    split_folder=Folder(opt['temp']);               test_writeable_folder(split_folder); set_MMlib_var('split_folder', split_folder) 
 
   # queueu usage mode
+  if not opt['sys'] in ['sge', 'slurm']: raise Exception, "ERROR -sys must be sge or slurm"
+  if opt['acct'] and opt['sys']!='slurm': raise Exception, "ERROR -acct is available only with -sys slurm"
   if opt['q']:
-    write(bbash('qstat -g c '+opt['x']), 1)
+    write(bbash( ('qstat -g c ' if opt['sys']=='sge' else 'sinfo -s ') +opt['x']), 1)
     sys.exit()
   
+  if opt['g']:
+    keys=str(opt['g']).split(',')
+    for k in keys:
+      if not k in job.__slots__: raise Exception, "ERROR -g accepts these attributes: "+' '.join(job.__slots__)
+
   ## setting input. if none, running qstat
   output_format=opt['f']
-  if opt['i']==0:
-    
-    qstat_options=opt['x']
-    if opt['a']:
-      qstat_options+=' -u \"*\" '
-      if output_format==def_opt['f']: output_format=opt['fa']
-    qstat_cmd='qstat -xml'+ qstat_options
-    input_file_h=bash_pipe(qstat_cmd)  ## opening pipe
-    
-  elif opt['i']!='-':
-    global input_file;   input_file=opt['i'];   check_file_presence(input_file, 'input_file')
-    input_file_h=open(input_file, 'r')
+  if   opt['sys']=='sge':  parse_jobs=parse_qstat_xml
+  elif opt['acct']:        parse_jobs=parse_sacct
+  else:                    parse_jobs=parse_squeue
+  user=os.environ.get('USER') or getpass.getuser()
+  def open_input():
+    """ Returns [file handler, process running the scheduler query, or None if reading from a file] """
+    if opt['i']==0:
+      qstat_options=opt['x']
+      if opt['sys']=='sge':
+        if opt['a']:      qstat_options+=' -u \"*\" '
+        qstat_cmd='qstat -xml'+ qstat_options
+      elif opt['acct']:   qstat_cmd="sacct -n -P -X -o "+sacct_fields+(' -a ' if opt['a'] else ' ')+qstat_options
+      else:               qstat_cmd="squeue -h -o '"+squeue_format+"'"+('' if opt['a'] else ' -u '+pipes.quote(user)+' ')+qstat_options   ## run without a shell: no $USER
+      process=bash_pipe(qstat_cmd, return_popen=True)  ## opening pipe
+      return [process.stdout, process]
+    elif opt['i']!='-':
+      global input_file;   input_file=opt['i'];   check_file_presence(input_file, 'input_file')
+      return [open(input_file, 'r'), None]
+    else:
+      return [sys.stdin, None]
+  def query_jobs():
+    """ Generator of job records from the input. A failed scheduler query raises an exception, rather than looking like an empty queue """
+    input_file_h, process=open_input()
+    for j in parse_jobs(input_file_h):  yield j
+    input_file_h.close()
+    if process and process.wait()!=0:
+      query='qstat' if opt['sys']=='sge' else 'sacct' if opt['acct'] else 'squeue'
+      raise Exception, "ERROR {} failed with exit status {}; see its error message above".format(query, process.returncode)
+  if opt['c'] and opt['i']==0:
+    cache_file=opt['cf']
+    if not cache_file:
+      ## one folder per user: without -a, queries list only the jobs of the user running them
+      cache_folder=tempfile.gettempdir()+'/qstat_parse_cache.{}/'.format(os.getuid())
+      if not os.path.isdir(cache_folder):
+        try:               os.mkdir(cache_folder, 0700)
+        except OSError:    pass        ## created by another process meanwhile
+      if os.lstat(cache_folder).st_uid!=os.getuid(): raise Exception, "ERROR cache folder "+cache_folder+" is not owned by the current user; use -cf to choose another cache file"
+      cache_file=cache_folder+md5( ' '.join([user, opt['sys'], str(opt['acct']), str(opt['a']), str(opt['x'])]) ).hexdigest()
+    cache=snapshot_cache(cache_file, opt['c'])
+    read_jobs=lambda : cache.jobs(query_jobs)
   else:
-    input_file_h=sys.stdin
-
-  for c in input_file_h:
-    c=c.strip()
-    if '<job_list' in c:
-      j=job()
-      j.tasks=''
-      j.slots=''
-    elif '<JB_job_number' in c:      j.id=c.split('>')[1].split('<')[0]
-    elif '<JAT_prio'  in  c:      j.priority=c.split('>')[1].split('<')[0]
-    elif '<JB_name'  in  c:      j.name=c.split('>')[1].split('<')[0]    
-    elif '<JB_owner'  in  c:      j.owner=c.split('>')[1].split('<')[0]    
-    elif '<state>'  in  c:      j.state=c.split('>')[1].split('<')[0]    
-    elif '<queue_name>' in c:   
-      j.queue = c.split('>')[1].split('<')[0].split('@')[0]
-      try: j.node = c.split('>')[1].split('<')[0].split('@')[1]
-      except: j.node=''
-    elif '<tasks' in c:
-      j.tasks = c.split('>')[1].split('<')[0]
-    elif '<slots' in c:
-      j.slots = c.split('>')[1].split('<')[0]
-
-    if '</job_list>' in c:   
-      #exec(opt['a'])
-      write(output_format.format(**j.__dict__), 1)
-
-    
-  input_file_h.close()
+    read_jobs=query_jobs
+  if opt['i']==0 and opt['a'] and output_format==def_opt['f']: output_format=opt['fa']
+
+  if opt['w']:
+    if opt['i']=='-': raise Exception, "ERROR -w cannot read the standard input more than once; use -i with a file, or no -i to run qstat"
+    progress=run_progress(opt['wr']) if opt['wr'] else None
+    previous=None;   n_polls=0
+    try:
+      while True:
+        current=job_snapshot(read_jobs())
+        n_polls+=1
+        now=time.strftime('%H:%M:%S')
+        if previous is None:   write('{} watching {} jobs or arrays'.format(now, len(current)), 1)
+        else:
+          for j, old_state, new_state in state_changes(previous, current):
+            write('{} {:9} {:6} {:>4} -> {:5} {}'.format(now, j.id, j.tasks, old_state or 'new', new_state, j.name), 1, how='red' if is_error_state(new_state, opt['sys']) else '')
+        previous=current
+        if progress:
+          n_done, n_submitted, rate, eta = progress.update(current)
+          write('{} run {}: {}/{} tasks done'.format(now, base_filename(progress.folder.rstrip('/')), n_done, n_submitted), 1)
+          if rate is not None:  write('  {:.2f} tasks/min, remaining time {}'.format(rate*60, time.strftime('%H:%M:%S', time.gmtime(eta)) if eta is not None else 'unknown'), 1)
+          write('', 1)
+          if n_submitted and n_done==n_submitted:  break
+        if opt['wn'] and n_polls>=opt['wn']:  break
+        time.sleep(opt['w'])
+    except KeyboardInterrupt:
+      pass
+    return
+
+  if opt['g']:
+    groups=aggregate_jobs(read_jobs(), keys)
+    rows=[ list(group)+[str(len(g[0])), str(g[1]), str(g[2])] for group, g in sorted(groups.items()) ]
+    rows.append( ['total']+['']*(len(keys)-1)+[ str(len(set().union(*[g[0] for g in groups.values()]))), 
+                                                str(sum(g[1] for g in groups.values())), str(sum(g[2] for g in groups.values())) ] )
+    header=keys+['jobs', 'tasks', 'slots']
+    widths=[ max(len(row[i]) for row in rows+[header]) for i in range(len(header)) ]
+    for row in [header]+rows:
+      write( ' '.join( row[i].ljust(widths[i]) if i<len(keys) else row[i].rjust(widths[i])  for i in range(len(header)) ), 1)
+    return
+
+  for j in read_jobs():
+    write(output_format.format(**j.as_dict()), 1)
 
   ###############
 